@@ -103,3 +103,50 @@ function create_parallel_build_chart_multi(target, title, compiler_and_data) {
         dataset: dataset
     });
 }
+
+function create_phase_chart(target, title, data, kind) {
+    // Stacks the phase_<name>_<kind> columns, and shows the total compile
+    // time of the phases as a line.
+    var suffix = '_' + kind;
+    var series = [];
+    var legend = [];
+    data[0].forEach(function (column) {
+        if (!column.startsWith('phase_') || !column.endsWith(suffix)) {
+            return;
+        }
+        var name = column.slice('phase_'.length, column.length - suffix.length);
+        legend.push(name);
+        if (name == 'total') {
+            series.push({
+                name: name,
+                type: 'line',
+                symbol: 'circle', symbolSize: 6,
+                encode: { x: 'dag_depth', y: column }
+            });
+        } else {
+            series.push({
+                name: name,
+                type: 'bar',
+                stack: 'phases',
+                encode: { x: 'dag_depth', y: column }
+            });
+        }
+    });
+    var chart = echarts.init(document.getElementById(target));
+    chart.setOption({
+        title: title,
+        legend: { data: legend, top: 'bottom' },
+        tooltip: {
+            trigger: 'axis',
+            axisPointer: { type: 'shadow' }
+        },
+        xAxis: [
+            { name: 'DAG Depth', type: 'category', nameLocation: 'center', nameGap: 30 }
+        ],
+        yAxis: [
+            { name: 'Compiler Seconds', type: 'value', nameLocation: 'center', nameGap: 45 }
+        ],
+        series: series,
+        dataset: { source: data }
+    });
+}
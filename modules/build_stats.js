@@ -24,6 +24,30 @@ function render_execution_item(params, api) {
     };
 }
 
+// Exec stats records are: slot, t0, t1, duration, id, kind, utime, stime,
+// maxrss (KiB), minflt, majflt, inblock, oublock, admit_wait, cpus, rchar,
+// wchar (bytes). Older records only have the first four fields, and the
+// fields a run could not measure are null.
+function execution_item_tooltip(params) {
+    var v = params.value;
+    var text = v[3] + ' s';
+    if (v.length > 5) {
+        text = v[5] + ' ' + v[4] + ': ' + text;
+        if (v[6] != null) {
+            text += '<br/>cpu: ' + (v[6] + v[7]).toFixed(3) + ' s (user '
+                + v[6].toFixed(3) + ', sys ' + v[7].toFixed(3) + ')'
+                + '<br/>max rss: ' + (v[8] / 1024).toFixed(1) + ' MiB'
+                + '<br/>faults: ' + v[9] + ' minor, ' + v[10] + ' major'
+                + '<br/>blocks: ' + v[11] + ' in, ' + v[12] + ' out';
+        }
+        if (v.length > 16 && v[15] != null) {
+            text += '<br/>io: ' + (v[15] / 1048576).toFixed(1) + ' MiB read, '
+                + (v[16] / 1048576).toFixed(1) + ' MiB written';
+        }
+    }
+    return text;
+}
+
 function create_execution_chart(target, title, data) {
     var categories = [];
     echarts.util.each(data, function(item, index) {
@@ -33,9 +57,7 @@ function create_execution_chart(target, title, data) {
     var chart = echarts.init(document.getElementById(target));
     chart.setOption({
         tooltip: {
-            formatter: function (params) {
-                return params.value[3] + ' s';
-            }
+            formatter: execution_item_tooltip
         },
         title: title,
         dataZoom: [{
@@ -92,4 +114,45 @@ function create_execution_chart(target, title, data) {
             data: data
         }]
     });
-}
\ No newline at end of file
+}
+
+// Plots the CPU time and max RSS of each exec stats record against its wall
+// clock duration, one series per task kind. Tasks with CPU time close to
+// their duration are CPU bound, the rest wait on memory or I/O.
+function create_resource_chart(target, title, data) {
+    var kinds = [];
+    var series = [];
+    echarts.util.each(data, function(item) {
+        if (item.length < 9 || item[6] == null) return;
+        var k = kinds.indexOf(item[5]);
+        if (k < 0) {
+            k = kinds.push(item[5]) - 1;
+            series.push({
+                name: item[5],
+                type: 'scatter',
+                symbolSize: function (value) {
+                    return Math.max(4, Math.sqrt(value[2] / 1024) * 2);
+                },
+                data: []
+            });
+        }
+        series[k].data.push([item[3], item[6] + item[7], item[8], item[4]]);
+    });
+    var chart = echarts.init(document.getElementById(target));
+    chart.setOption({
+        title: title,
+        legend: { data: kinds },
+        tooltip: {
+            formatter: function (params) {
+                var v = params.value;
+                return params.seriesName + ' ' + v[3]
+                    + '<br/>wall: ' + v[0].toFixed(3) + ' s'
+                    + '<br/>cpu: ' + v[1].toFixed(3) + ' s'
+                    + '<br/>max rss: ' + (v[2] / 1024).toFixed(1) + ' MiB';
+            }
+        },
+        xAxis: { name: 'Wall Clock Seconds', type: 'value', nameLocation: 'center', nameGap: 30 },
+        yAxis: { name: 'CPU Seconds', type: 'value', nameLocation: 'center', nameGap: 45 },
+        series: series
+    });
+}
@@ -0,0 +1,341 @@
+#!/usr/bin/env python3
+"""
+    Copyright (C) 2018-2019 Rene Rivera.
+    Use, modification and distribution are subject to the
+    Boost Software License, Version 1.0. (See accompanying file
+    LICENSE_1_0.txt or copy at http://www.boost.org/LICENSE_1_0.txt)
+"""
+import json
+import os.path
+import random
+import re
+import shlex
+import sys
+from parallel_perf import Main, Test
+
+
+class ImportDag(Main):
+    '''
+    Converts the dependency graph of a real project to a DAG file, for
+    parallel_perf.py --dag-in to generate and build TUs of the same shape.
+    Each file of the project becomes a TU that depends on the files it
+    includes or imports. The TUs are put in levels by their longest chain
+    of dependencies, as the generated DAGs are.
+    '''
+
+    formats = ['auto', 'edges', 'ninja-deps', 'ninja-graph',
+               'compile-commands']
+
+    def __init_parser__(self, parser):
+        parser.add_argument(
+            'graph',
+            help='The file with the dependency graph, or "-" for stdin.')
+        parser.add_argument(
+            '--format', default='auto', choices=self.formats,
+            help='The form of the graph. Either: edges, lines of a file followed by the files it depends on; ninja-deps, the output of "ninja -t deps"; ninja-graph, the output of "ninja -t graph"; or compile-commands, a compile_commands.json whose sources are scanned for includes and imports. The default guesses it from the content.')
+        parser.add_argument(
+            '--exclude',
+            help='Regular expression of the files to leave out, like system headers. The dependencies through them are kept.')
+        parser.add_argument(
+            '--seed', default=None, type=int,
+            help='Seed for the random choice of the per TU options.')
+        parser.add_argument(
+            '--dag-out', required=True,
+            help='Save the DAG to this JSON file.')
+
+    def __run__(self):
+        graph_format = self.args.format
+        if self.args.graph == '-':
+            content = sys.stdin.read()
+        else:
+            with open(self.args.graph, 'r') as f:
+                content = f.read()
+        if graph_format == 'auto':
+            graph_format = self.__guess_format__(content)
+        graph = getattr(self, '__read_%s__' % (
+            graph_format.replace('-', '_')))(content)
+        if self.args.exclude:
+            graph = self.__exclude__(graph, re.compile(self.args.exclude))
+        cycles = self.__break_cycles__(graph)
+        levels = self.__levels__(graph)
+        self.__save_data__(self.args.dag_out, {
+            'format': Test.__dag_format__,
+            'version': Test.__dag_version__,
+            'seed': self.args.seed,
+            'count': len(graph),
+            'dag_depth': len(levels),
+            'source': os.path.abspath(self.args.graph)
+            if self.args.graph != '-' else None,
+            'source_format': graph_format,
+            'levels': levels,
+        })
+        print('TUS: %s, DEPS: %s, DEPTH: %s, MAX DEPS: %s, CYCLE DEPS DROPPED: %s' % (
+            len(graph), sum([len(d) for d in graph.values()]), len(levels),
+            max([len(d) for d in graph.values()], default=0), cycles))
+
+    def __guess_format__(self, content):
+        text = content.lstrip()
+        if text.startswith('['):
+            return 'compile-commands'
+        if text.startswith('digraph'):
+            return 'ninja-graph'
+        if re.search(r'^\S.*: #deps \d+', content, re.MULTILINE):
+            return 'ninja-deps'
+        return 'edges'
+
+    def __read_edges__(self, content):
+        # "file dep dep ...", where a file can be on more than one line, and
+        # "#" starts a comment.
+        graph = {}
+        for line in content.splitlines():
+            words = shlex.split(line, comments=True)
+            if words:
+                graph.setdefault(words[0], set()).update(words[1:])
+        return self.__add_nodes__(graph)
+
+    def __read_ninja_deps__(self, content):
+        # The deps of each target, as recorded from the depfiles. The first
+        # is the source of the target, that then depends on the rest. Ninja
+        # only records all the headers of each source, and not which of them
+        # includes which, so the headers have no dependencies.
+        graph = {}
+        deps = None
+        for line in content.splitlines():
+            if re.match(r'^\S.*: #deps \d+', line):
+                deps = []
+            elif line.strip() and deps is not None:
+                if not deps:
+                    graph.setdefault(line.strip(), set())
+                else:
+                    graph[deps[0]].add(line.strip())
+                deps.append(line.strip())
+            else:
+                deps = None
+        return self.__add_nodes__(graph)
+
+    def __read_ninja_graph__(self, content):
+        # The graphviz graph, where the files are labeled boxes and the edges
+        # go from inputs to outputs. Build statements with one input and one
+        # output are a labeled edge, the others go through an ellipse node
+        # for the rule. Each statement is collapsed onto its first input that
+        # is a source, i.e. that no statement builds, and its outputs, like
+        # the object and the BMI, stand for that source. Statements without a
+        # source input, like links, and phony ones are dropped, and their
+        # outputs stand for what their inputs stand for.
+        labels = {}
+        rules = {}
+        edges = []
+        for line in content.splitlines():
+            node = re.match(r'^"(\w+)" \[label="(.*?)"(, shape=ellipse)?', line)
+            edge = re.match(
+                r'^"(\w+)" -> "(\w+)"(?: \[label=" ?(.*?)"\])?', line)
+            if edge:
+                edges.append(edge.groups())
+            elif node:
+                if node.group(3):
+                    rules[node.group(1)] = node.group(2)
+                else:
+                    labels[node.group(1)] = node.group(2)
+        statements = {}
+        for i, o, rule in edges:
+            if i in rules:
+                statements.setdefault(i, (rules[i], [], []))[2].append(o)
+            elif o in rules:
+                statements.setdefault(o, (rules[o], [], []))[1].append(i)
+            else:
+                statements[(i, o)] = (rule, [i], [o])
+        producer = {}
+        for s, (rule, inputs, outputs) in statements.items():
+            for o in outputs:
+                producer[o] = s
+        sources = {}
+        for s, (rule, inputs, outputs) in statements.items():
+            primary = [i for i in inputs if i not in producer]
+            if rule != 'phony' and primary:
+                sources[s] = primary[0]
+        stands_for = {}
+
+        def tus(f):
+            if f not in producer:
+                return set([labels[f]])
+            if f not in stands_for:
+                p = producer[f]
+                if p in sources:
+                    stands_for[f] = set([labels[sources[p]]])
+                else:
+                    stands_for[f] = set()
+                    for i in statements[p][1]:
+                        stands_for[f].update(tus(i))
+            return stands_for[f]
+        graph = {}
+        for s, source in sources.items():
+            deps = graph.setdefault(labels[source], set())
+            for i in statements[s][1]:
+                if i != source:
+                    deps.update(tus(i))
+            deps.discard(labels[source])
+        return self.__add_nodes__(graph)
+
+    def __read_compile_commands__(self, content):
+        # Scans the sources, and the headers they include, for the includes
+        # that resolve with the include paths of the command, and for the
+        # modules they export and import. Includes that do not resolve, like
+        # the standard library ones, are left out.
+        graph = {}
+        provides = {}
+        imports = {}
+        todo = []
+        for command in json.loads(content):
+            dir = command['directory']
+            args = command.get('arguments') or shlex.split(command['command'])
+            todo.append((os.path.normpath(os.path.join(dir, command['file'])),
+                         self.__include_dirs__(dir, args)))
+        while todo:
+            path, include_dirs = todo.pop()
+            if path in graph:
+                continue
+            deps = graph[path] = set()
+            with open(path, 'r', errors='replace') as f:
+                source = f.read()
+            for m in re.finditer(
+                    r'^\s*(?:#\s*include|(?:export\s+)?import)\s*([<"])([^>"]+)[>"]',
+                    source, re.MULTILINE):
+                dirs = include_dirs['angle'] if m.group(1) == '<' else \
+                    [os.path.dirname(path)] + include_dirs['quote']
+                header = self.__resolve__(m.group(2), dirs)
+                if header:
+                    deps.add(header)
+                    todo.append((header, include_dirs))
+            m = re.search(r'^\s*export\s+module\s+([\w.:]+)\s*;',
+                          source, re.MULTILINE)
+            if m:
+                provides[m.group(1)] = path
+            imports[path] = re.findall(
+                r'^\s*(?:export\s+)?import\s+([\w.]+)\s*;',
+                source, re.MULTILINE)
+        for path, names in imports.items():
+            graph[path].update(
+                [provides[n] for n in names if n in provides])
+        return graph
+
+    def __include_dirs__(self, dir, args):
+        # The directories of the quoted and of the angle bracket includes.
+        include_dirs = {'quote': [], 'angle': []}
+        i = 0
+        while i < len(args):
+            for option, kinds in [
+                    ('-iquote', ['quote']), ('-isystem', ['angle']),
+                    ('-I', ['quote', 'angle'])]:
+                if args[i].startswith(option):
+                    value = args[i][len(option):]
+                    if not value and i+1 < len(args):
+                        i += 1
+                        value = args[i]
+                    for k in kinds:
+                        include_dirs[k].append(
+                            os.path.normpath(os.path.join(dir, value)))
+                    break
+            i += 1
+        return include_dirs
+
+    def __resolve__(self, name, dirs):
+        for dir in dirs:
+            path = os.path.normpath(os.path.join(dir, name))
+            if os.path.isfile(path):
+                return path
+        return None
+
+    def __add_nodes__(self, graph):
+        # The dependencies are TUs too.
+        for deps in list(graph.values()):
+            for d in deps:
+                graph.setdefault(d, set())
+        return graph
+
+    def __exclude__(self, graph, pattern):
+        # Drops the matching files, and has the files that depend on them
+        # depend on their dependencies instead.
+        kept = {}
+        for node in graph:
+            if pattern.search(node):
+                continue
+            deps = set()
+            seen = set()
+            todo = list(graph[node])
+            while todo:
+                d = todo.pop()
+                if d in seen:
+                    continue
+                seen.add(d)
+                if pattern.search(d):
+                    todo.extend(graph[d])
+                elif d != node:
+                    deps.add(d)
+            kept[node] = deps
+        return kept
+
+    def __break_cycles__(self, graph):
+        # Headers can include each other, and the include guards stop the
+        # cycle. TUs can not, so the dependencies that close a cycle are
+        # dropped, and their number returned.
+        dropped = 0
+        state = {}
+        for root in sorted(graph):
+            if root in state:
+                continue
+            state[root] = 'open'
+            stack = [(root, iter(sorted(graph[root])))]
+            while stack:
+                node, deps = stack[-1]
+                d = next(deps, None)
+                if d is None:
+                    state[node] = 'done'
+                    stack.pop()
+                elif state.get(d) == 'open':
+                    graph[node].discard(d)
+                    dropped += 1
+                elif d not in state:
+                    state[d] = 'open'
+                    stack.append((d, iter(sorted(graph[d]))))
+        return dropped
+
+    def __levels__(self, graph):
+        # The level of a TU is one more than the deepest of its deps. The
+        # TUs are numbered in level order, so that the deps come first.
+        level = {}
+        for root in sorted(graph):
+            todo = [root]
+            while todo:
+                node = todo[-1]
+                if node in level:
+                    todo.pop()
+                    continue
+                pending = [d for d in graph[node] if d not in level]
+                if pending:
+                    todo.extend(pending)
+                    continue
+                level[node] = 1 + max(
+                    [level[d] for d in graph[node]], default=-1)
+                todo.pop()
+        order = sorted(graph, key=lambda n: (level[n], n))
+        index = dict([(n, i) for i, n in enumerate(order)])
+        rand = random.Random(self.args.seed)
+        levels = []
+        for node in order:
+            if level[node] == len(levels):
+                levels.append([])
+            levels[-1].append({
+                'index': index[node],
+                'deps': sorted([index[d] for d in graph[node]]),
+                'c_include': rand.randrange(len(Test.__c_includes__)),
+                'name': node,
+            })
+        return levels
+
+
+# ninja -C build -t deps | ./dag_import.py --dag-out=dag.json -
+# ./dag_import.py --exclude='^/usr/' --dag-out=dag.json build/compile_commands.json
+# ./parallel_perf.py --dir=/tmp/cpp_stats --dag-in=dag.json --kind=headers,modules
+
+if __name__ == "__main__":
+    ImportDag()
@@ -0,0 +1,395 @@
+#!/usr/bin/env python3
+"""
+    Copyright (C) 2018-2019 Rene Rivera.
+    Use, modification and distribution are subject to the
+    Boost Software License, Version 1.0. (See accompanying file
+    LICENSE_1_0.txt or copy at http://www.boost.org/LICENSE_1_0.txt)
+"""
+import json
+import os
+import os.path
+import re
+import shlex
+import socket
+import sys
+import time
+
+
+class FakeCxx(object):
+    '''
+    A stand in for the compiler, to benchmark the test harness without a
+    modules capable toolset. It takes the gcc and clang command lines that
+    parallel_perf.py uses, reads the sources, the precompiled header, and the
+    BMIs of the imported modules and header units, burns CPU time and holds memory in proportion to what it read,
+    and writes the BMI, object, and dependency files that are asked for.
+
+    The costs are fitted to the clang exec stats in data/ (150 TUs with
+    --def-ints and the default complexity, i.e. 300 declarations per TU):
+    about 45ms for a TU with nothing to include, 5ms more for each of the
+    included headers, and 12ms for each BMI loaded. The FAKE_CXX_CPU and
+    FAKE_CXX_MEM environment variables scale the CPU time and memory.
+    '''
+
+    # Seconds of CPU time.
+    base_cost = 0.045
+    line_cost = 1.6e-5
+    bmi_cost = 0.012
+    codegen_line_cost = 1.0e-5
+    scan_line_cost = 1.0e-6
+    # Lines that a system header, i.e. an angle bracket include, counts as.
+    system_header_lines = 2000
+    # Bytes.
+    base_mem = 32*1024*1024
+    line_mem = 2*1024
+    bmi_line_size = 64
+    obj_line_size = 32
+
+    def __init__(self, argv):
+        self.cpu_scale = float(os.getenv('FAKE_CXX_CPU', '1'))
+        self.mem_scale = float(os.getenv('FAKE_CXX_MEM', '1'))
+        self.output = None
+        self.depfile = None
+        self.md = False
+        self.precompile = False
+        self.language = None
+        self.header_unit = False
+        self.prefix_headers = []
+        self.module_files = {}
+        self.module_mapper = None
+        self.time_report = False
+        self.time_trace = None
+        self.deps_format = None
+        self.deps_file = None
+        self.deps_target = None
+        self.inputs = []
+        if argv and argv[0] == '-format=p1689':
+            # As clang-scan-deps, that gets the compile command after the
+            # "--", and prints the dependencies.
+            self.deps_format = 'p1689r5'
+            argv = argv[argv.index('--')+2:]
+        self.__parse_args__(self.__expand_args__(argv))
+
+    def __expand_args__(self, argv):
+        # Response files, as clang reads them.
+        result = []
+        for arg in argv:
+            if arg.startswith('@'):
+                with open(arg[1:], 'r') as f:
+                    result.extend(f.read().split())
+            else:
+                result.append(arg)
+        return result
+
+    def __parse_args__(self, args):
+        i = 0
+        while i < len(args):
+            arg = args[i]
+            if arg in ['-o', '-MF', '-MT', '-x', '-I', '-include']:
+                i += 1
+                value = args[i]
+                if arg == '-o':
+                    self.output = value
+                elif arg == '-MF':
+                    self.depfile = value
+                elif arg == '-x':
+                    self.language = value
+                elif arg == '-include':
+                    self.prefix_headers.append(value)
+            elif arg == '-MD':
+                self.md = True
+            elif arg == '--precompile':
+                self.precompile = True
+            elif arg.startswith('-fmodule-header'):
+                self.header_unit = True
+            elif arg.startswith('-fmodule-mapper='):
+                self.module_mapper = arg.split('=', 1)[1].strip('"')
+            elif arg.startswith('-fdeps-format='):
+                self.deps_format = arg.split('=', 1)[1]
+            elif arg.startswith('-fdeps-file='):
+                self.deps_file = arg.split('=', 1)[1]
+            elif arg.startswith('-fdeps-target='):
+                self.deps_target = arg.split('=', 1)[1]
+            elif arg == '-ftime-report':
+                self.time_report = True
+            elif arg.startswith('-ftime-trace='):
+                self.time_trace = arg.split('=', 1)[1]
+            elif arg.startswith('-fmodule-file='):
+                value = arg.split('=', 1)[1]
+                if '=' in value:
+                    name, path = value.split('=', 1)
+                else:
+                    # A header unit, that is named in its BMI.
+                    path = value
+                    name = self.__read_bmi__(path)['module']
+                self.module_files[name] = path
+            elif not arg.startswith('-'):
+                self.inputs.append(arg)
+            i += 1
+        if len(self.inputs) != 1:
+            self.__error__('expected one input file, got %s' % (
+                len(self.inputs)))
+        if self.language == 'c++-header' and (
+                self.output or not self.header_unit):
+            # A precompiled header, or a clang header unit, goes to the
+            # output. The gcc header units are written as the modules are.
+            self.precompile = True
+        self.mapper_server = None
+        if self.deps_format:
+            # Scanning does not need the modules.
+            return
+        server = re.match(r'^(.+):(\d+)(\?.*)?$', self.module_mapper or '')
+        if server and not os.path.exists(self.module_mapper):
+            # A mapper server, that speaks the libcody protocol.
+            self.mapper_server = socket.create_connection(
+                (server.group(1), int(server.group(2)))).makefile('rwb')
+            self.__mapper_request__('HELLO 1 FAKE_CXX %s' % (self.inputs[0]))
+        elif self.module_mapper:
+            with open(self.module_mapper, 'r') as f:
+                for line in f:
+                    line = line.split()
+                    if len(line) == 2:
+                        self.module_files[line[0]] = line[1]
+
+    def __mapper_request__(self, request):
+        self.mapper_server.write((request + '\n').encode('utf8'))
+        self.mapper_server.flush()
+        response = shlex.split(self.mapper_server.readline().decode('utf8'))
+        if not response or response[0] == 'ERROR':
+            self.__error__('mapper: %s' % (' '.join(response[1:])))
+        return response
+
+    def __module_file__(self, request, name):
+        # The BMI of the module, from the mapper server or the module map.
+        if self.mapper_server:
+            return self.__mapper_request__('%s %s' % (request, name))[1]
+        if name in self.module_files:
+            return self.module_files[name]
+        if request == 'MODULE-EXPORT':
+            return os.path.join('gcm.cache', name+'.gcm')
+        self.__error__('module "%s" not found' % (name))
+
+    def __error__(self, message):
+        sys.stderr.write('fake_cxx: error: %s\n' % (message))
+        sys.exit(1)
+
+    def run(self):
+        source = self.inputs[0]
+        self.lines = 0
+        self.bmis = []
+        self.headers = []
+        self.imports = []
+        self.module = None
+        # The headers read, as absolute paths or system header names.
+        self.seen = set()
+        # The cost of each phase, named as in the gcc time report.
+        phases = {'phase setup': self.base_cost}
+        if self.deps_format:
+            self.__read_source__(source, self.seen)
+            phases['phase parsing'] = self.scan_line_cost*self.lines
+            self.__burn__(sum(phases.values())*self.cpu_scale)
+            self.__write_deps__(source)
+            return
+        if source.endswith('.pcm'):
+            # Code generation from a BMI only loads that BMI.
+            bmi = self.__read_bmi__(source)
+            self.module = bmi['module']
+            self.lines = bmi['lines']
+            self.seen.update(bmi['headers'])
+            phases['module import'] = self.bmi_cost
+            phases['phase opt and generate'] = \
+                self.codegen_line_cost*self.lines
+            mem = self.lines*self.line_mem
+        else:
+            for header in self.prefix_headers:
+                self.__read_prefix__(header, self.seen)
+            if self.header_unit:
+                self.module = self.__header_unit_name__(source)
+            self.__read_source__(source, self.seen)
+            for name in self.imports:
+                self.bmis.append(self.__read_bmi__(
+                    self.__module_file__('MODULE-IMPORT', name)))
+            phases['phase parsing'] = self.line_cost*self.lines
+            phases['module import'] = self.bmi_cost*len(self.bmis)
+            if not self.precompile:
+                phases['phase opt and generate'] = \
+                    self.codegen_line_cost*self.lines
+            mem = self.lines*self.line_mem \
+                + sum([b['size'] for b in self.bmis])
+        phases = dict([(k, v*self.cpu_scale) for k, v in phases.items()])
+        hold = b'\1' * int((self.base_mem+mem)*self.mem_scale)
+        self.__burn__(sum(phases.values()))
+        self.__write_outputs__(source)
+        self.__write_phases__(phases)
+        del hold
+
+    def __read_prefix__(self, header, seen):
+        # The -include header, from its precompiled header when there is one.
+        for pch in [header+'.gch', header+'.pch']:
+            if os.path.exists(pch):
+                bmi = self.__read_bmi__(pch)
+                seen.update(bmi['headers'])
+                self.bmis.append(bmi)
+                return
+        self.__read_source__(header, seen)
+
+    def __header_unit_name__(self, path):
+        # Header units are named by their path, as gcc does for the quoted
+        # ones it finds relative to the current directory.
+        path = os.path.normpath(path)
+        if os.path.isabs(path):
+            return path
+        return './' + path
+
+    def __read_source__(self, path, seen):
+        # Reads the source and, once, each of the quoted includes. Counting
+        # the declaration lines, and collecting the module interface name
+        # and imports.
+        seen.add(os.path.abspath(path))
+        if path != self.inputs[0]:
+            self.headers.append(path)
+        with open(path, 'r') as f:
+            for line in f:
+                line = line.strip()
+                include = re.match(r'#include\s+"([^"]+)"', line)
+                if include:
+                    header = os.path.join(
+                        os.path.dirname(path), include.group(1))
+                    if os.path.abspath(header) not in seen:
+                        self.__read_source__(header, seen)
+                    continue
+                system = re.match(r'#include\s+<([^>]+)>', line)
+                if system:
+                    if system.group(1) not in seen:
+                        seen.add(system.group(1))
+                        self.lines += self.system_header_lines
+                    continue
+                module = re.match(r'export\s+module\s+([\w.]+)\s*;', line)
+                if module:
+                    self.module = module.group(1)
+                    continue
+                imported = re.match(r'import\s+([\w.]+)\s*;', line)
+                if imported:
+                    self.imports.append(imported.group(1))
+                    continue
+                imported = re.match(r'import\s+"([^"]+)"\s*;', line)
+                if imported:
+                    self.imports.append(self.__header_unit_name__(
+                        os.path.join(os.path.dirname(path), imported.group(1))))
+                    continue
+                if line and not line.startswith('#'):
+                    self.lines += 1
+
+    def __read_bmi__(self, path):
+        if not os.path.exists(path):
+            self.__error__('BMI "%s" not found' % (path))
+        with open(path, 'rb') as f:
+            bmi = json.loads(f.readline().decode('utf8'))
+            bmi['size'] = len(f.read())
+        return bmi
+
+    def __burn__(self, seconds):
+        # CPU time, not wall time, so that contention for the cores slows
+        # the build down as it does for a real compiler. The process time
+        # counts from the start, so the python start up is part of it.
+        x = 0
+        while time.process_time() < seconds:
+            for i in range(1000):
+                x = (x*31+i) & 0xffffffff
+
+    def __write_outputs__(self, source):
+        base = os.path.splitext(os.path.basename(source))[0]
+        obj = None
+        if self.precompile:
+            self.__write_bmi__(self.output or base+'.pcm')
+        elif self.header_unit:
+            self.__write_bmi__(self.__module_file__(
+                'MODULE-EXPORT', self.module))
+            if self.mapper_server:
+                self.__mapper_request__('MODULE-COMPILED %s' % (
+                    self.module))
+        else:
+            obj = self.output or base+'.o'
+            if self.module and not source.endswith('.pcm'):
+                # The gcc style of writing the BMI as a side effect.
+                self.__write_bmi__(self.__module_file__(
+                    'MODULE-EXPORT', self.module))
+                if self.mapper_server:
+                    self.__mapper_request__('MODULE-COMPILED %s' % (
+                        self.module))
+            with open(obj, 'wb') as f:
+                f.write(b'\0' * (self.lines*self.obj_line_size))
+        if self.md:
+            target = self.output or obj
+            depfile = self.depfile or os.path.splitext(target)[0]+'.d'
+            with open(depfile, 'w') as f:
+                f.write('%s: %s\n' % (
+                    target, ' \\\n  '.join([source]+self.headers)))
+
+    def __write_phases__(self, phases):
+        total = sum(phases.values())
+        if self.time_report:
+            sys.stderr.write('Time variable%s usr sys wall GGC\n' % (' '*34))
+            for name, t in phases.items():
+                sys.stderr.write(
+                    ' %-35s:  %.3f (%3d%%)  0.000 (  0%%)  %.3f (%3d%%)     0k (  0%%)\n' % (
+                        name, t, 100*t/total, t, 100*t/total))
+            sys.stderr.write(' %-35s:  %.3f         0.000         %.3f            0k\n' % (
+                'TOTAL', total, total))
+        if self.time_trace:
+            # The clang time trace totals, where the frontend includes the
+            # parsing of the source and the loading of the modules.
+            parsing = phases.get('phase parsing', 0.0)
+            module_load = phases.get('module import', 0.0)
+            totals = {
+                'ExecuteCompiler': total,
+                'Frontend': parsing+module_load,
+                'Source': parsing,
+                'Module Load': module_load,
+                'Backend': phases.get('phase opt and generate', 0.0),
+            }
+            with open(self.time_trace, 'w') as f:
+                json.dump({'traceEvents': [{
+                    'name': 'Total ' + name, 'ph': 'X', 'ts': 0,
+                    'dur': int(t*1000000), 'pid': 1, 'tid': 0,
+                } for name, t in totals.items()]}, f)
+
+    def __write_deps__(self, source):
+        # The P1689 dependencies of the source, to the -fdeps-file or, for
+        # clang-scan-deps, to stdout.
+        rule = {
+            'primary-output': self.deps_target or self.output,
+            'requires': [{'logical-name': name} for name in self.imports],
+        }
+        if self.module:
+            rule['provides'] = [
+                {'logical-name': self.module, 'is-interface': True}]
+        deps = json.dumps(
+            {'version': 1, 'revision': 0, 'rules': [rule]}, indent=2)
+        if self.deps_file:
+            with open(self.deps_file, 'w') as f:
+                f.write(deps)
+            if self.output and self.output != os.devnull:
+                with open(source, 'r') as i, open(self.output, 'w') as o:
+                    o.write(i.read())
+            if self.md and self.depfile:
+                with open(self.depfile, 'w') as f:
+                    f.write('%s: %s\n' % (
+                        self.deps_file, ' \\\n  '.join([source]+self.headers)))
+        else:
+            sys.stdout.write(deps + '\n')
+
+    def __write_bmi__(self, path):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(json.dumps({
+                'module': self.module,
+                'lines': self.lines,
+                'imports': self.imports,
+                'headers': sorted(self.seen),
+            }).encode('utf8')+b'\n')
+            f.write(b'\0' * (self.lines*self.bmi_line_size))
+
+
+if __name__ == "__main__":
+    FakeCxx(sys.argv[1:]).run()
@@ -7,6 +7,12 @@
 """
 import argparse
 import copy
+import csv
+import glob
+import hashlib
+import heapq
+import io
+import itertools
 import json
 import math
 import multiprocessing
@@ -15,9 +21,14 @@ import os.path
 import pprint
 import random
 import re
-import shutil
+import select
+import shlex
+import socket
+import socketserver
+import statistics
+import sys
 import ninja_syntax
-from subprocess import check_call, call, check_output
+from subprocess import check_call, call, check_output, Popen, CalledProcessError
 from time import sleep
 from timeit import default_timer
 import threading
@@ -66,8 +77,10 @@ class Commands():
             return json.load(f)
 
     def __save_data__(self, json_file, data):
+        # Strict JSON, that the charts can parse, without NaN or Infinity.
         json_out = json.dumps(
-            data, sort_keys=True, indent=2, separators=(',', ': '))
+            data, sort_keys=True, indent=2, separators=(',', ': '),
+            allow_nan=False)
         if not self.args.debug:
             with open(json_file, "w") as f:
                 f.write(json_out)
@@ -109,100 +122,860 @@ class PushDir():
         os.chdir(self.cwd)
 
 
+class SourceTree():
+    '''
+    Incrementally writes generated files into a directory. Files whose
+    content hash matches the one recorded in the manifest are left as is,
+    and previously generated files that are not generated again are removed
+    when the tree is closed. Files written without content are kept as they
+    were generated before.
+    '''
+
+    manifest_name = '.manifest.json'
+
+    def __init__(self, dir, debug=False):
+        self.dir = os.path.abspath(dir)
+        self.debug = debug
+        self.written = 0
+        self.skipped = 0
+        self.removed = 0
+        self.__files__ = {}
+        self.__previous__ = {}
+        manifest = os.path.join(self.dir, self.manifest_name)
+        if os.path.isfile(manifest):
+            with open(manifest, 'r') as f:
+                self.__previous__ = json.load(f).get('files', {})
+        if not os.path.exists(self.dir):
+            os.makedirs(self.dir)
+
+    def write(self, path, content):
+        rel = os.path.relpath(os.path.join(self.dir, path), self.dir)
+        if content is None:
+            if rel in self.__previous__:
+                self.__files__[rel] = self.__previous__[rel]
+            self.skipped += 1
+            return False
+        digest = hashlib.sha1(content.encode('utf8')).hexdigest()
+        self.__files__[rel] = digest
+        path = os.path.join(self.dir, rel)
+        if self.__previous__.get(rel) == digest and os.path.isfile(path):
+            self.skipped += 1
+            return False
+        if not self.debug:
+            with open(path, 'w') as f:
+                f.write(content)
+        self.written += 1
+        return True
+
+    def symlink(self, source, path):
+        rel = os.path.relpath(os.path.join(self.dir, path), self.dir)
+        self.__files__[rel] = 'symlink:' + source
+        path = os.path.join(self.dir, rel)
+        if os.path.islink(path) and os.readlink(path) == source:
+            self.skipped += 1
+            return False
+        if not self.debug:
+            if os.path.lexists(path):
+                os.remove(path)
+            os.symlink(source, path)
+        self.written += 1
+        return True
+
+    def close(self):
+        for rel in set(self.__previous__) - set(self.__files__):
+            path = os.path.join(self.dir, rel)
+            if os.path.lexists(path):
+                if not self.debug:
+                    os.remove(path)
+                self.removed += 1
+        if not self.debug:
+            with open(os.path.join(self.dir, self.manifest_name), 'w') as f:
+                json.dump({'files': self.__files__}, f,
+                          sort_keys=True, indent=0)
+
+
+class ResultsLog():
+    '''
+    Append only JSON Lines log of test records. Each record is written out
+    as soon as it is added, and the records already in the log are loaded
+    so that an interrupted test can resume where it left off. The first
+    record holds the options the log was started with, and resuming with
+    different options is an error.
+    '''
+
+    def __init__(self, path, config, debug=False):
+        self.path = path
+        self.debug = debug
+        self.records = []
+        config = json.loads(json.dumps(config))
+        if self.path and os.path.isfile(self.path):
+            with open(self.path, 'r+') as f:
+                content = f.read()
+                # Drop a partial last record from an interrupted write.
+                if content and not content.endswith('\n'):
+                    content = content[:content.rfind('\n')+1]
+                    if not self.debug:
+                        f.seek(0)
+                        f.truncate()
+                        f.write(content)
+            for line in content.splitlines():
+                if line.strip():
+                    self.records.append(json.loads(line))
+        logged = self.find('config')
+        if not logged:
+            self.append({'record': 'config', 'config': config})
+        elif logged[0]['config'] != config:
+            raise ValueError(
+                'Results log "%s" was started with different options.' % (
+                    self.path))
+
+    def find(self, record, **keys):
+        return [r for r in self.records if r['record'] == record
+                and all([r.get(k) == v for k, v in keys.items()])]
+
+    def append(self, record):
+        self.records.append(record)
+        if self.path and not self.debug:
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(
+                    record, sort_keys=True, allow_nan=False) + '\n')
+
+
+class ModuleMapper():
+    '''
+    GCC module mapper server. It speaks the libcody protocol, that gcc uses
+    with -fmodule-mapper=host:port, on the IPv6 loopback. The module name to
+    BMI queries are answered from an in memory index, and every request is
+    logged with the seconds since the last reset.
+    '''
+
+    def __init__(self):
+        self.__map__ = {}
+        self.__repo__ = '.'
+        self.__lock__ = threading.Lock()
+        self.__clients__ = 0
+        self.reset()
+        mapper = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                mapper.__serve__(self.rfile, self.wfile)
+
+        class Server(socketserver.ThreadingTCPServer):
+            # The gcc mapper client only connects over IPv6.
+            address_family = socket.AF_INET6
+            daemon_threads = True
+
+        self.__server__ = Server(('::1', 0), Handler)
+        self.__thread__ = threading.Thread(
+            target=self.__server__.serve_forever)
+        self.__thread__.daemon = True
+        self.__thread__.start()
+
+    @property
+    def address(self):
+        return '::1:%s' % (self.__server__.server_address[1])
+
+    def set_map(self, repo, module_map):
+        # The maps of the kinds, that are generated before any of them run,
+        # are merged. Their names do not overlap, and the BMI paths are
+        # absolute, so the repo does not change where they are.
+        with self.__lock__:
+            self.__repo__ = repo
+            self.__map__.update(module_map)
+
+    def reset(self):
+        with self.__lock__:
+            self.__t0__ = default_timer()
+            self.__clients__ = 0
+            self.log = []
+
+    def close(self):
+        self.__server__.shutdown()
+        self.__server__.server_close()
+
+    def __serve__(self, rfile, wfile):
+        with self.__lock__:
+            client = self.__clients__
+            self.__clients__ += 1
+        while True:
+            # Requests come in batches, where all but the last end in " ;",
+            # and are answered in a batch of the same form.
+            batch = []
+            while True:
+                line = rfile.readline()
+                if not line:
+                    return
+                line = line.decode('utf8').rstrip('\n')
+                more = line.endswith(' ;')
+                batch.append(line[:-2] if more else line)
+                if not more:
+                    break
+            responses = [self.__respond__(client, r) for r in batch]
+            wfile.write((' ;\n'.join(responses) + '\n').encode('utf8'))
+            wfile.flush()
+
+    def __respond__(self, client, request):
+        t = default_timer()
+        words = shlex.split(request)
+        command = words[0] if words else ''
+        if command == 'HELLO':
+            response = 'HELLO 1 parallel_perf'
+        elif command == 'MODULE-REPO':
+            response = 'PATHNAME %s' % (self.__quote__(self.__repo__))
+        elif command in ['MODULE-EXPORT', 'MODULE-IMPORT'] and len(words) > 1:
+            if words[1] in self.__map__:
+                response = 'PATHNAME %s' % (
+                    self.__quote__(self.__map__[words[1]]))
+            else:
+                response = 'ERROR %s' % (
+                    self.__quote__('unknown module ' + words[1]))
+        elif command == 'MODULE-COMPILED':
+            response = 'OK'
+        elif command == 'INCLUDE-TRANSLATE':
+            response = 'BOOL FALSE'
+        else:
+            response = 'ERROR %s' % (
+                self.__quote__('unknown request ' + command))
+        with self.__lock__:
+            self.log.append({
+                't': t-self.__t0__, 'client': client,
+                'request': request, 'response': response})
+        return response
+
+    def __quote__(self, word):
+        if re.match(r"^[^\s'\\]+$", word):
+            return word
+        return "'%s'" % (word.replace('\\', '\\\\').replace("'", "\\'"))
+
+    def modules(self):
+        # The module each client exported, and the modules it imported.
+        clients = {}
+        for r in self.log:
+            words = shlex.split(r['request'])
+            c = clients.setdefault(r['client'], {'export': None, 'imports': []})
+            if words[0] == 'MODULE-EXPORT':
+                c['export'] = words[1]
+            elif words[0] == 'MODULE-IMPORT':
+                c['imports'].append(words[1])
+        return clients
+
+
 class Executor(object):
-    def __init__(self, processes):
+    schedules = ['fifo', 'critical-path', 'dependents', 'random']
+
+    # The fields of each command_stats record. CPU times are in seconds,
+    # maxrss in KiB, and the rest are counts as reported by getrusage. The
+    # admit_wait is the seconds the task was held back by the memory budget.
+    # And cpus the CPUs the task was allowed to run on, or None for any. The
+    # rchar and wchar are the bytes the command read and wrote, as reported
+    # by /proc/<pid>/io, or None where that is not available.
+    stats_fields = [
+        'slot', 't0', 't1', 'duration', 'id', 'kind',
+        'utime', 'stime', 'maxrss', 'minflt', 'majflt', 'inblock', 'oublock',
+        'admit_wait', 'cpus', 'rchar', 'wchar']
+
+    def __init__(self, processes, schedule='fifo', mem_budget=0):
+        if schedule not in self.schedules:
+            raise ValueError('Executor: unknown schedule "%s".' % (schedule))
         self.__command_deps__ = {}
         self.__command__ = {}
+        self.__command_kind__ = {}
+        self.__outputs__ = {}
         self.__processes__ = int(processes)
+        self.__schedule_policy__ = schedule
+        # Memory admission, in KiB. The RSS model holds the largest max RSS
+        # seen for each task kind and is shared with copies of the executor.
+        self.__mem_budget__ = int(mem_budget)
+        self.__rss_model__ = {}
+        self.__affinity__ = None
         self.__pool__ = None
         self.__lock__ = threading.Lock()
+        self.__ready_cv__ = threading.Condition(self.__lock__)
         self.__t0__ = None
         self.__command_stats__ = []
         self.__thread_index__ = 0
-
-    def copy(self):
-        o = Executor(self.__processes__)
+        # Scheduling state, derived from the task graph at run time.
+        self.__dependents__ = {}
+        self.__in_degree__ = {}
+        self.__priority__ = {}
+        self.__ready__ = []
+        self.__ready_seq__ = 0
+        self.__pending__ = 0
+        self.__running__ = 0
+        self.__error__ = None
+        self.__mem_in_use__ = 0
+        self.__admitted__ = {}
+        self.__admit_t0__ = {}
+        self.__admit_wait__ = {}
+
+    def copy(self, processes=None):
+        o = self.__class__(
+            processes or self.__processes__, self.__schedule_policy__,
+            self.__mem_budget__)
+        o.__rss_model__ = self.__rss_model__
+        o.__affinity__ = self.__affinity__
         o.__command_deps__ = copy.deepcopy(self.__command_deps__)
         o.__command__ = copy.copy(self.__command__)
-        o.__lock__ = threading.Lock()
+        o.__command_kind__ = copy.copy(self.__command_kind__)
+        o.__outputs__ = self.__outputs__
+        return o
+
+    def subset(self, ids):
+        # A copy with only the given tasks, dependencies on the other tasks
+        # are considered satisfied.
+        o = self.copy()
+        ids = set(ids)
+        for id in list(o.__command__.keys()):
+            if id not in ids:
+                del o.__command__[id]
+                del o.__command_deps__[id]
+                del o.__command_kind__[id]
         return o
 
-    def add_task(self, command, id, deps):
+    @property
+    def ids(self):
+        return list(self.__command__.keys())
+
+    def kind(self, id):
+        return self.__command_kind__.get(id)
+
+    def add_output(self, output, id):
+        # Records which task produces the output file, for matching the
+        # tasks to the ninja build statements.
+        self.__outputs__[os.path.abspath(output)] = id
+
+    def output_task(self, output):
+        return self.__outputs__.get(os.path.abspath(output))
+
+    @property
+    def outputs(self):
+        return list(self.__outputs__.keys())
+
+    def set_affinity(self, cpus):
+        # The CPU sets to pin the job slots, and the commands they run, to.
+        # Slot i uses set i modulo their number. None does not pin.
+        self.__affinity__ = cpus
+
+    def slot_cpus(self, index):
+        if not self.__affinity__:
+            return None
+        return self.__affinity__[index % len(self.__affinity__)]
+
+    def add_task(self, command, id, deps, kind=None):
         self.__lock__.acquire()
         self.__command__[id] = command
         self.__command_deps__[id] = set(deps)
+        self.__command_kind__[id] = kind
+        self.__lock__.release()
+
+    def set_deps(self, id, deps):
+        # Replaces the dependencies of the task, as when they are found by
+        # scanning the sources instead of known from the generator.
+        self.__lock__.acquire()
+        self.__command_deps__[id] = set(deps)
         self.__lock__.release()
 
     def run(self):
+        self.__schedule__()
         self.__pool__ = [threading.Thread(
             target=self.next_command) for x in range(self.__processes__)]
-        # self.__lock__.acquire()
         self.__t0__ = default_timer()
         for t in self.__pool__:
             t.start()
-        self.__t0__ = default_timer()
-        # self.__lock__.release()
         for t in self.__pool__:
             t.join()
+        if self.__error__:
+            raise self.__error__
+
+    def __schedule__(self):
+        # Build the reverse dependency index and the in-degree counters so
+        # that completing a task only touches the tasks that depend on it.
+        # Dependencies on ids that are not tasks are considered satisfied.
+        self.__dependents__ = {id: [] for id in self.__command__}
+        self.__in_degree__ = {}
+        for id in self.__command__:
+            deps = [d for d in self.__command_deps__[id]
+                    if d in self.__command__]
+            self.__in_degree__[id] = len(deps)
+            for d in deps:
+                self.__dependents__[d].append(id)
+        self.__priority__ = getattr(
+            self, '__priority_%s__' % (
+                self.__schedule_policy__.replace('-', '_')))()
+        self.__ready__ = []
+        self.__ready_seq__ = 0
+        for id in self.__command__:
+            if self.__in_degree__[id] == 0:
+                self.__push_ready__(id)
+        self.__pending__ = len(self.__command__)
+        self.__running__ = 0
+        self.__error__ = None
+        self.__mem_in_use__ = 0
+        self.__admitted__ = {}
+        self.__admit_t0__ = {}
+        self.__admit_wait__ = {}
+
+    def __push_ready__(self, id):
+        # The ready queue is a heap ordered by the schedule priority, ties
+        # are broken by the order in which the tasks became ready.
+        heapq.heappush(
+            self.__ready__, (self.__priority__.get(id, 0), self.__ready_seq__, id))
+        self.__ready_seq__ += 1
+
+    def __topological_order__(self):
+        in_degree = dict(self.__in_degree__)
+        order = [id for id in self.__command__ if in_degree[id] == 0]
+        for id in order:
+            for d in self.__dependents__[id]:
+                in_degree[d] -= 1
+                if in_degree[d] == 0:
+                    order.append(d)
+        return order
+
+    def task_cost(self, id):
+        return 1.0
+
+    # Priorities map task ids to a sort key, lowest runs first.
+
+    def __priority_fifo__(self):
+        return {}
+
+    def __priority_critical_path__(self):
+        # Longest remaining path, in task cost, from each task to the end
+        # of the build.
+        remaining = {}
+        for id in reversed(self.__topological_order__()):
+            remaining[id] = self.task_cost(id) + max(
+                [remaining[d] for d in self.__dependents__[id]], default=0.0)
+        return {id: -r for id, r in remaining.items()}
+
+    def __priority_dependents__(self):
+        return {id: -len(d) for id, d in self.__dependents__.items()}
+
+    def __priority_random__(self):
+        return {id: random.random() for id in self.__command__}
 
     def next_command(self):
         self.__lock__.acquire()
         index = self.__thread_index__
         self.__thread_index__ += 1
         self.__lock__.release()
-        while len(self.__command__) > 0:
+        # The commands are spawned from this thread, and inherit its CPUs.
+        if self.slot_cpus(index):
+            os.sched_setaffinity(0, self.slot_cpus(index))
+        while True:
             c = self.pick_command()
-            if c:
-                t0 = default_timer()-self.__t0__
-                c[1][0](*c[1][1:])
-                t1 = default_timer()-self.__t0__
-                self.__lock__.acquire()
-                self.__command_stats__.append([index, t0, t1, t1-t0])
-                self.__lock__.release()
-                self.complete_command(c[0])
-            else:
-                sleep(0.001)
+            if not c:
+                break
+            t0 = default_timer()-self.__t0__
+            rusage, io = None, None
+            try:
+                spec = c[1][0](*c[1][1:])
+                if spec:
+                    rusage, io = self.__spawn__(spec)
+            except BaseException as e:
+                self.fail_command(c[0], e)
+                break
+            t1 = default_timer()-self.__t0__
+            self.__lock__.acquire()
+            self.__command_stats__.append(
+                self.__record__(index, t0, t1, c[0], rusage, io))
+            self.__lock__.release()
+            self.complete_command(c[0])
+
+    # Tasks can return a spawn spec, a dict with either the 'command' to run
+    # in the 'cwd' directory, or a 'delay' to simulate running something.
+    # The 'stdout' and 'stderr' of the command go to those files when given.
+    def __spawn__(self, spec):
+        if 'delay' in spec:
+            sleep(spec['delay'])
+            return None, None
+        outputs = self.__open_outputs__(spec)
+        try:
+            p = Popen(spec['command'], cwd=spec.get('cwd'), **outputs)
+        finally:
+            for f in outputs.values():
+                f.close()
+        pid, status, rusage, io = self.__wait__(p.pid)
+        p.returncode = os.waitstatus_to_exitcode(status)
+        if p.returncode != 0:
+            raise CalledProcessError(p.returncode, p.args)
+        return rusage, io
+
+    def __open_outputs__(self, spec):
+        return dict([(o, open(spec[o], 'w'))
+                     for o in ['stdout', 'stderr'] if o in spec])
+
+    def __wait__(self, pid):
+        # Waits for the child to exit. The I/O counters of the child are read
+        # while it is a zombie, before reaping it.
+        io = None
+        if hasattr(os, 'waitid'):
+            os.waitid(os.P_PID, pid, os.WEXITED | os.WNOWAIT)
+            io = self.__read_io__(pid)
+        pid, status, rusage = os.wait4(pid, 0)
+        return pid, status, rusage, io
+
+    def __read_io__(self, pid):
+        try:
+            with open('/proc/%s/io' % (pid), 'r') as f:
+                io = dict([l.split(':', 1) for l in f if ':' in l])
+            return dict([(k, int(io[k])) for k in ['rchar', 'wchar']])
+        except (OSError, KeyError, ValueError):
+            return None
+
+    def __record__(self, index, t0, t1, id, rusage, io=None):
+        kind = self.__command_kind__.get(id)
+        record = [index, t0, t1, t1-t0, id, kind]
+        if rusage:
+            maxrss = rusage.ru_maxrss // (
+                1024 if sys.platform == 'darwin' else 1)
+            record.extend([
+                rusage.ru_utime, rusage.ru_stime, maxrss,
+                rusage.ru_minflt, rusage.ru_majflt,
+                rusage.ru_inblock, rusage.ru_oublock])
+            self.__rss_model__[kind] = max(
+                maxrss, self.__rss_model__.get(kind, 0))
+        else:
+            record.extend([None]*7)
+        record.append(self.__admit_wait__.get(id, 0.0))
+        cpus = self.slot_cpus(index)
+        record.append(sorted(cpus) if cpus else None)
+        record.extend([io['rchar'], io['wchar']] if io else [None]*2)
+        return record
+
+    def __project_rss__(self, kind):
+        # The largest max RSS seen for the kind. A kind that has not been
+        # seen yet gets an even share of the budget, whatever the other
+        # kinds used, so that a full set of jobs can start.
+        if kind in self.__rss_model__:
+            return self.__rss_model__[kind]
+        return self.__mem_budget__ // self.__processes__
+
+    def __admit__(self, id):
+        # Admit the task if its projected RSS fits in what is left of the
+        # budget. Something is always admitted when nothing is running.
+        if self.__mem_budget__ <= 0:
+            return True
+        rss = self.__project_rss__(self.__command_kind__.get(id))
+        if self.__running__ > 0 \
+                and self.__mem_in_use__ + rss > self.__mem_budget__:
+            self.__admit_t0__.setdefault(id, default_timer())
+            return False
+        if id in self.__admit_t0__:
+            self.__admit_wait__[id] = \
+                default_timer() - self.__admit_t0__.pop(id)
+        self.__admitted__[id] = rss
+        self.__mem_in_use__ += rss
+        return True
+
+    def __release__(self, id):
+        self.__mem_in_use__ -= self.__admitted__.pop(id, 0)
+
+    def __admit_ready__(self):
+        return self.__admit__(self.__ready__[0][2])
+
+    def __pop_ready__(self):
+        id = heapq.heappop(self.__ready__)[2]
+        self.__running__ += 1
+        return (id, self.__command__[id])
 
     def pick_command(self):
-        result = None
-        self.__lock__.acquire()
-        for id, command in self.__command__.items():
-            if len(self.__command_deps__[id]) == 0:
-                result = (id, command)
-                break
-        if result:
-            del self.__command__[id]
-        self.__lock__.release()
-        return result
+        # Blocks until a task is ready, or returns None when there is
+        # nothing left to run.
+        with self.__ready_cv__:
+            while not self.__error__ and self.__pending__ > 0 \
+                    and not (self.__ready__ and self.__admit_ready__()):
+                if self.__running__ == 0 and not self.__ready__:
+                    self.__error__ = RuntimeError(
+                        'Executor: dependency cycle among %s tasks.' % (
+                            self.__pending__))
+                    self.__ready_cv__.notify_all()
+                    break
+                self.__ready_cv__.wait()
+            if self.__error__ or not self.__ready__:
+                return None
+            return self.__pop_ready__()
 
     def complete_command(self, id):
-        self.__lock__.acquire()
-        for k in self.__command_deps__.keys():
-            self.__command_deps__[k].discard(id)
-        self.__lock__.release()
+        with self.__ready_cv__:
+            self.__running__ -= 1
+            self.__pending__ -= 1
+            self.__release__(id)
+            ready = 0
+            for d in self.__dependents__[id]:
+                self.__in_degree__[d] -= 1
+                if self.__in_degree__[d] == 0:
+                    self.__push_ready__(d)
+                    ready += 1
+            if self.__pending__ == 0 or self.__running__ == 0 \
+                    or self.__mem_budget__ > 0:
+                self.__ready_cv__.notify_all()
+            elif ready > 0:
+                self.__ready_cv__.notify(ready)
+
+    def fail_command(self, id, error):
+        with self.__ready_cv__:
+            self.__running__ -= 1
+            self.__release__(id)
+            if not self.__error__:
+                self.__error__ = error
+            self.__ready_cv__.notify_all()
 
     @property
     def command_stats(self):
         return self.__command_stats__
 
+    def analyze(self, command_stats=None):
+        '''
+        Combines the task graph with the measured command stats, of this
+        executor or of another run of the same tasks. Returns the critical
+        path length, the ideal time for the number of processes, the peak
+        number of concurrent jobs, the utilization of each job slot, and
+        the idle slot time split into the time spent waiting for
+        dependencies, while there were tasks to start, and the idle time
+        after the last task started. Times are in seconds.
+        '''
+        if command_stats is None:
+            command_stats = self.__command_stats__
+        if not command_stats:
+            return {}
+        duration = {}
+        for r in command_stats:
+            duration[r[4]] = duration.get(r[4], 0.0) + r[3]
+        # Longest path through the graph, weighted by the task durations.
+        deps = dict([(id, [d for d in self.__command_deps__.get(id, [])
+                           if d in duration]) for id in duration])
+        finish = {}
+        for id in duration:
+            todo = [id]
+            while todo:
+                t = todo[-1]
+                if t in finish:
+                    todo.pop()
+                    continue
+                pending = [d for d in deps[t] if d not in finish]
+                if pending:
+                    todo.extend(pending)
+                    continue
+                finish[t] = duration[t] + max(
+                    [finish[d] for d in deps[t]], default=0.0)
+                todo.pop()
+        t_start = min([r[1] for r in command_stats])
+        t_end = max([r[2] for r in command_stats])
+        makespan = t_end - t_start
+        work = math.fsum([r[3] for r in command_stats])
+        # Sweep the start and end events for the concurrency and idle time.
+        events = sorted(
+            [(r[1], 1) for r in command_stats]
+            + [(r[2], -1) for r in command_stats])
+        starts = sorted([r[1] for r in command_stats])
+        running = 0
+        peak = 0
+        started = 0
+        dep_wait = 0.0
+        idle_wait = 0.0
+        for i, (t, delta) in enumerate(events):
+            running += delta
+            if delta > 0:
+                started += 1
+            peak = max(peak, running)
+            if i+1 < len(events):
+                idle = max(0, self.__processes__-running) \
+                    * (events[i+1][0]-t)
+                if started < len(starts):
+                    dep_wait += idle
+                else:
+                    idle_wait += idle
+        busy = [0.0]*max(self.__processes__, 1+max(
+            [r[0] for r in command_stats]))
+        for r in command_stats:
+            busy[r[0]] += r[3]
+        return {
+            'critical_path': max(finish.values()),
+            'ideal_time': max(
+                max(finish.values()), work/self.__processes__),
+            'dag_jobs': work/makespan if makespan > 0 else 0.0,
+            'peak_jobs': peak,
+            'utilization': [
+                b/makespan if makespan > 0 else 0.0 for b in busy],
+            'dep_wait': dep_wait,
+            'idle_wait': idle_wait,
+        }
+
+    @property
+    def schedule(self):
+        return self.__schedule_policy__
+
+    @property
+    def admit_wait(self):
+        return math.fsum(self.__admit_wait__.values())
+
+
+class ProcessExecutor(Executor):
+    '''
+    Executor that runs all the tasks from the calling thread. The task
+    commands are launched as child processes, up to the processes limit,
+    and reaped as they finish with a single wait loop.
+    '''
+
+    def run(self):
+        self.__schedule__()
+        self.__t0__ = default_timer()
+        children = {}
+        slots = list(reversed(range(self.__processes__)))
+        while True:
+            while slots and self.__ready__ and not self.__error__ \
+                    and self.__admit_ready__():
+                c = self.__pop_ready__()
+                index = slots.pop()
+                t0 = default_timer()-self.__t0__
+                try:
+                    spec = c[1][0](*c[1][1:])
+                    p = self.__popen__(spec, index) if spec else None
+                except BaseException as e:
+                    self.fail_command(c[0], e)
+                    slots.append(index)
+                    break
+                if p:
+                    children[p.pid] = (c[0], index, t0, p)
+                else:
+                    slots.append(index)
+                    self.__complete__(c[0], index, t0, None)
+            if not children:
+                if self.__error__ or self.__pending__ == 0:
+                    break
+                if not self.__ready__:
+                    self.__error__ = RuntimeError(
+                        'Executor: dependency cycle among %s tasks.' % (
+                            self.__pending__))
+                    break
+                continue
+            pid, status, rusage, io = self.__wait__(
+                self.__wait_any__(list(children.keys())))
+            id, index, t0, p = children.pop(pid)
+            p.returncode = os.waitstatus_to_exitcode(status)
+            slots.append(index)
+            if p.returncode != 0:
+                self.fail_command(id, CalledProcessError(p.returncode, p.args))
+            else:
+                self.__complete__(id, index, t0, rusage, io)
+        if self.__error__:
+            raise self.__error__
+
+    def __popen__(self, spec, index):
+        # The children are spawned from this thread, that runs the loop
+        # alone, and inherit its CPUs. So these are set around the launch,
+        # and not by a preexec_fn, which is not safe with the other threads
+        # of the process.
+        cpus = self.slot_cpus(index)
+        affinity = os.sched_getaffinity(0) if cpus else None
+        if affinity:
+            os.sched_setaffinity(0, cpus)
+        try:
+            if 'delay' in spec:
+                # Simulated work still goes through a child process so that
+                # it exercises the same launch and reap path.
+                return Popen(['sleep', '%.3f' % (spec['delay'])])
+            outputs = self.__open_outputs__(spec)
+            try:
+                return Popen(spec['command'], cwd=spec.get('cwd'), **outputs)
+            finally:
+                for f in outputs.values():
+                    f.close()
+        finally:
+            if affinity:
+                os.sched_setaffinity(0, affinity)
+
+    def __wait_any__(self, pids):
+        # The pid of a child that exited, without reaping it. Only the given
+        # children are waited for, as the generator pool workers are also
+        # children of the process. With pidfds where there are, else polling.
+        if hasattr(os, 'pidfd_open'):
+            fds = {}
+            try:
+                for pid in pids:
+                    fds[os.pidfd_open(pid)] = pid
+                ready = select.select(list(fds.keys()), [], [])[0]
+                return fds[ready[0]]
+            except OSError:
+                pass
+            finally:
+                for fd in fds:
+                    os.close(fd)
+        if not hasattr(os, 'waitid'):
+            # Without a way to wait without reaping, wait for the oldest.
+            return pids[0]
+        while True:
+            for pid in pids:
+                if os.waitid(os.P_PID, pid,
+                             os.WEXITED | os.WNOHANG | os.WNOWAIT):
+                    return pid
+            sleep(0.001)
+
+    def __complete__(self, id, index, t0, rusage, io=None):
+        t1 = default_timer()-self.__t0__
+        self.__command_stats__.append(
+            self.__record__(index, t0, t1, id, rusage, io))
+        self.complete_command(id)
+
+
+class SimulatedExecutor(Executor):
+    '''
+    Executor that runs the tasks on a virtual clock. The command of each
+    task is its duration, in seconds, and a task starts, in the order of the
+    schedule policy, as soon as it is ready and a job slot is free. The
+    memory budget is not simulated.
+    '''
+
+    def run(self):
+        self.__schedule__()
+        self.__t0__ = 0.0
+        now = 0.0
+        running = []
+        running_seq = 0
+        slots = list(reversed(range(self.__processes__)))
+        while True:
+            while slots and self.__ready__:
+                id, duration = self.__pop_ready__()
+                heapq.heappush(
+                    running, (now+duration, running_seq, id, slots.pop(), now))
+                running_seq += 1
+            if not running:
+                if self.__pending__ > 0:
+                    raise RuntimeError(
+                        'Executor: dependency cycle among %s tasks.' % (
+                            self.__pending__))
+                break
+            now, _, id, index, t0 = heapq.heappop(running)
+            slots.append(index)
+            self.__command_stats__.append(
+                self.__record__(index, t0, now, id, None))
+            self.complete_command(id)
+
+    def task_cost(self, id):
+        # The critical path is weighted by the simulated durations.
+        return self.__command__[id]
+
 
 class Test(Main):
     def __init_parser__(self, parser):
         parser.add_argument(
             '--test', default='build',
-            help='The test to run. Can be one of: build.')
+            help='The test to run. Can be one of: build, rebuild, dag, sources, schedule. Where dag only generates the DAG, sources only renders the sources of each kind, and schedule only schedules the tasks of the DAG on a simulated clock, to benchmark those.')
         parser.add_argument(
             '--kind', default='headers,modules',
-            help='The type of tests to run. Can be a command separated list of any of: headers, modules.')
+            help='The type of tests to run. Can be a command separated list of any of: headers, pch, header-units, modules. Where pch precompiles a prefix header, of the system headers and the headers of the first DAG level, that all the TUs include. And header-units imports each header as a header unit.')
         parser.add_argument(
             '--dir', required=True,
             help='The directory root to generate the test files.')
         parser.add_argument(
-            '--count', default=150, type=int,
-            help='Number of TUs to generate and process.')
+            '--count', default='150',
+            help='Number of TUs to generate and process. A comma separated list sweeps over each.')
         parser.add_argument(
-            '--complexity', default=0.3, type=float,
-            help='Complexity of generated code in each TU from 0 to 1, where 1 is most complex.')
+            '--complexity', default='0.3',
+            help='Complexity of generated code in each TU from 0 to 1, where 1 is most complex. A comma separated list sweeps over each.')
         parser.add_argument(
             '--dag-depth', default='2,3',
             help='The range of DAG depths to test as two comma separated values.')
@@ -213,8 +986,8 @@ class Test(Main):
             '--dep-max', default=3, type=int,
             help='Maximum number of generated dependencies in source files.')
         parser.add_argument(
-            '--jobs', default=2, type=int,
-            help='Maximum number of parallel jobs to use.')
+            '--jobs', default='2',
+            help='Maximum number of parallel jobs to use. A comma separated list sweeps over each.')
         parser.add_argument(
             '--use-std', default=False, action='store_true',
             help='Generate references to standard library in the source.')
@@ -225,8 +998,11 @@ class Test(Main):
             '--def-ints', default=False, action='store_true',
             help='Generate integer variable declarations in the source.')
         parser.add_argument(
-            '--json-out', required=True,
+            '--json-out',
             help='Output resulting test data table as JSON to a file.')
+        parser.add_argument(
+            '--table-out',
+            help='Output the results as a long format table, with a row for each run, to a CSV or JSON Lines file as per its extension.')
         parser.add_argument(
             '--dag-samples', default=20, type=int,
             help='Number of samples to test in the dag range.')
@@ -239,14 +1015,71 @@ class Test(Main):
         parser.add_argument(
             '--run-samples', default=5, type=int,
             help='Number of times to run each test and average.')
+        parser.add_argument(
+            '--edit-node', default='mid', type=self.__edit_node_arg__,
+            help='The TU to edit for the rebuild test. Can be one of: root, the first TU of the first DAG level that the others build on; mid, the first TU of the middle level; leaf, the first TU of the last level; or a TU index.')
+        parser.add_argument(
+            '--edit', default='touch', choices=['touch', 'edit'],
+            help='How to change the TU for the rebuild test, i.e. only update its time stamp or also its content.')
+        parser.add_argument(
+            '--ci-width', default=0.0, type=float,
+            help='Sample adaptively, i.e. after --run-samples keep running each test until the 95%% confidence interval half width is at most this fraction of the mean. The reported time is then the median.')
+        parser.add_argument(
+            '--max-samples', default=30, type=int,
+            help='Maximum number of times to run each test when sampling adaptively.')
         parser.add_argument(
             '--toolset', default='gcc',
-            help='Which toolset to run tests for. Can be one or more of: gcc, clang.')
+            help='Which toolset to run tests for. Can be one or more of: gcc, clang. Sources are shared by the toolsets, and only the build files are generated again for each. The compiler of each is the CXX_GCC or CXX_CLANG environment variable, else CXX.')
+        parser.add_argument(
+            '--fake-cxx', default=False, action='store_true',
+            help='Compile with the bundled fake_cxx.py compiler stand in, instead of the toolset compiler.')
         parser.add_argument(
             '--use-ninja', default=False, action='store_true',
             help='Use ninja rather than python to run the compiler')
+        parser.add_argument(
+            '--backend', default='thread', choices=['thread', 'process'],
+            help='How the python executor runs the compiler, i.e. from a thread per job or from a single process reaping loop.')
+        parser.add_argument(
+            '--mem-budget', default=0, type=int,
+            help='Memory budget, in MiB, for the compilers the python executor runs at once. Zero for no limit.')
+        parser.add_argument(
+            '--affinity', default='none', choices=['none', 'packed', 'spread'],
+            help='Pin each job slot, and the compilers it runs, to a CPU. Either packed, filling one NUMA node before the next, or spread, round robin over the NUMA nodes. Ninja builds are only restricted to the CPUs of the slots.')
+        parser.add_argument(
+            '--cores', default=0, type=int,
+            help='Restrict the build to this many CPUs, chosen as per --affinity, to emulate a smaller machine. Zero for all the CPUs.')
+        parser.add_argument(
+            '--time-phases', default=False, action='store_true',
+            help='Time the phases of each compile, with -ftime-report for gcc or -ftime-trace for clang, and report the total of each phase.')
+        parser.add_argument(
+            '--module-mapper', default='file', choices=['file', 'server'],
+            help='How gcc finds the BMIs of the modules. Either from the mm.csv file that lists them all, or by asking a mapper server the test runs, which logs the requests.')
+        parser.add_argument(
+            '--mapper-log',
+            help='Save the requests the mapper server got in the last build, and the modules each TU exported and imported, to this JSON file.')
+        parser.add_argument(
+            '--scan', default=False, action='store_true',
+            help='Scan the module sources for their imports, in parallel, before each modules build, with -fdeps-format=p1689r5 for gcc or clang-scan-deps for clang. The executor builds with the dependencies found instead of the generated ones, and the scan time is reported apart from the build time. The clang scanner is the CLANG_SCAN_DEPS environment variable, else the one next to the compiler.')
         parser.add_argument(
             '--exec-stats')
+        parser.add_argument(
+            '--schedule', default='fifo', choices=Executor.schedules,
+            help='Order in which the python executor starts ready tasks.')
+        parser.add_argument(
+            '--seed', default=None, type=int,
+            help='Seed for the random generation of the DAGs, and other random choices, to make runs repeatable.')
+        parser.add_argument(
+            '--dag-in',
+            help='Load the DAG of each sample from this JSON file, instead of generating it. As saved with --dag-out, or converted from the graph of a real project with dag_import.py. A "{dag_depth}" in the name is replaced with the depth of the sample. Without it the file is the only sample.')
+        parser.add_argument(
+            '--dag-out',
+            help='Save the DAG of each sample to this JSON file. A "{dag_depth}" in the name is replaced with the depth of the sample.')
+        parser.add_argument(
+            '--log-out',
+            help='Append each result record to this JSON Lines file as soon as it completes, and skip the records already in it. Use with --seed or --dag-in for the resumed samples to build the same DAGs.')
+        parser.add_argument(
+            '--gen-jobs', default=multiprocessing.cpu_count(), type=int,
+            help='Number of processes to generate the test sources with.')
 
     def __run__(self):
         self.dir = os.getcwd()
@@ -254,80 +1087,713 @@ class Test(Main):
         args_dag_depth = [int(i) for i in args_dag_depth]
         if len(args_dag_depth) == 1:
             args_dag_depth.append(args_dag_depth[0]+1)
+        if self.args.seed is not None:
+            random.seed(self.args.seed)
+        if self.args.dag_in and '{dag_depth}' not in self.args.dag_in:
+            # A single DAG file is a single sample at its depth.
+            args_dag_depth = [self.__load_data__(self.args.dag_in)['dag_depth']]
+            args_dag_depth.append(args_dag_depth[0]+1)
         args_kind = self.args.kind
         data = []
         dag_depth_range = range(
             args_dag_depth[0], args_dag_depth[1],
             max([1, int((args_dag_depth[1]-args_dag_depth[0])/self.args.dag_samples)]))
         test_x = getattr(self, '__test_%s__' % (self.args.test), False)
-        for dag_depth in dag_depth_range:
-            self.args.dag_depth = dag_depth
-            self.args.kind = args_kind
-            sample = test_x()
-            data.append(sample)
-        json_data = [["dag_depth", "headers", "modules"]]
-        for d in data:
-            data_row = [d['dag_depth']]
-            if 'headers' in d:
-                data_row.append(d['headers'])
-            if 'modules' in d:
-                data_row.append(d['modules'])
-            json_data.append(data_row)
+        self.__results_log__ = ResultsLog(
+            self.args.log_out,
+            dict([(k, getattr(self.args, k)) for k in self.__log_config__]),
+            self.args.debug)
+        # The grid of options to sweep. The count and complexity change the
+        # sources, so they are the outer loops. The toolsets and jobs share
+        # the sources of each sample, and are the inner loops of the tests.
+        self.__grid__ = {
+            'count': [int(v) for v in self.args.count.split(',')],
+            'complexity': [float(v) for v in self.args.complexity.split(',')],
+            'toolset': self.args.toolset.split(','),
+            'jobs': [int(v) for v in self.args.jobs.split(',')],
+        }
+        self.args.toolset = self.__grid__['toolset'][0]
+        self.args.jobs = self.__grid__['jobs'][0]
+        self.__table_rows__ = []
+        self.__cpu_placement__ = self.__placement__()
+        # The generator processes are forked before the mapper server thread
+        # starts, and only for the tests that generate the sources.
+        if self.args.gen_jobs > 1 and self.args.test in ['build', 'rebuild']:
+            self.__gen_pool__ = multiprocessing.Pool(self.args.gen_jobs)
+        self.__mapper__ = ModuleMapper() \
+            if self.args.module_mapper == 'server' else None
+        try:
+            for count in self.__grid__['count']:
+                for complexity in self.__grid__['complexity']:
+                    for dag_depth in dag_depth_range:
+                        self.args.count = count
+                        self.args.complexity = complexity
+                        self.args.dag_depth = dag_depth
+                        self.args.kind = args_kind
+                        sample = test_x()
+                        for k in ['count', 'complexity']:
+                            if len(self.__grid__[k]) > 1:
+                                sample[k] = getattr(self.args, k)
+                        data.append(sample)
+        finally:
+            if getattr(self, '__gen_pool__', None):
+                self.__gen_pool__.close()
+                self.__gen_pool__.join()
+                del self.__gen_pool__
+            if self.__mapper__:
+                self.__mapper__.close()
+        json_data = self.__table__(data, [
+            self.__series__(kind, toolset, jobs)
+            for kind in args_kind.split(',')
+            for toolset in self.__grid__['toolset']
+            for jobs in self.__grid__['jobs']])
         if self.args.json_out:
             self.__save_data__(self.args.json_out, json_data)
+        if self.args.table_out:
+            self.__save_table__(self.args.table_out, self.__table_rows__)
+
+    # The options that have to match to resume from a results log.
+    __log_config__ = [
+        'test', 'kind', 'count', 'complexity', 'dag_depth', 'dag_samples',
+        'dep_factor', 'dep_max', 'jobs', 'use_std', 'def_templates',
+        'def_ints', 'use_c_headers', 'toolset', 'fake_cxx', 'use_ninja',
+        'backend', 'schedule', 'mem_budget', 'affinity', 'cores',
+        'time_phases', 'module_mapper', 'scan', 'seed', 'dag_in',
+        'edit_node', 'edit']
+
+    def __test_dag__(self):
+        # Benchmarks generating the DAG of the sample.
+        t0 = default_timer()
+        self.__sample_dag__()
+        return {
+            'dag_depth': self.args.dag_depth,
+            'count': int(self.args.count),
+            'dag_time': default_timer()-t0,
+        }
+
+    def __test_schedule__(self):
+        # Benchmarks the scheduling of the executor, i.e. the ready queue
+        # and the dependency bookkeeping, with the task graph of the sample
+        # replayed on the simulated clock. Each task takes a second, so the
+        # only real time is that of the scheduling.
+        self.__sample_dag__()
+        x = SimulatedExecutor(self.args.jobs, self.args.schedule)
+        for dag_level in self.dag['levels']:
+            for m in dag_level:
+                x.add_task(1.0, str(m['index']),
+                           [str(d) for d in m['deps']], 'modules')
+        t0 = default_timer()
+        x.run()
+        return {
+            'dag_depth': self.args.dag_depth,
+            'count': int(self.args.count),
+            'schedule_time': default_timer()-t0,
+        }
+
+    def __test_sources__(self):
+        # Benchmarks rendering the sources of the TUs of the sample, for each
+        # kind, without writing them. The cached declaration block is cleared
+        # first, so that the first TU pays for rendering it.
+        self.__sample_dag__()
+        result = {
+            'dag_depth': self.args.dag_depth,
+            'count': int(self.args.count),
+        }
+        dag_deps = {}
+        dag_options = {}
+        for dag_level in self.dag['levels']:
+            for m in dag_level:
+                dag_deps[m['index']] = m['deps']
+                dag_options[m['index']] = m
+        for kind in self.args.kind.split(','):
+            self.args.kind = kind
+            if kind == 'modules':
+                make_x, id_t = self.__make_module_source__, 'm%s'
+            else:
+                make_x, id_t = self.__make_headers_source__, 'h%s'
+            self.__cpp_code_cache__.clear()
+            t0 = default_timer()
+            for n in range(int(self.args.count)):
+                make_x(id_t % (n), [id_t % (d) for d in dag_deps[n]],
+                       dag_options[n])
+            result['source_time_' + kind] = default_timer()-t0
+        return result
+
+    def __table__(self, data, kinds):
+        # The leading columns are the ones the charts expect, i.e. the
+        # depth and the per kind times, any other results follow.
+        columns = ['dag_depth']
+        for kind in kinds:
+            if any(kind in d for d in data):
+                columns.append(kind)
+        columns.extend(sorted(set(k for d in data for k in d) - set(columns)))
+        table = [columns]
+        for d in data:
+            table.append([d.get(c) for c in columns])
+        return table
+
+    __executors__ = {
+        'thread': Executor,
+        'process': ProcessExecutor,
+    }
+
+    def __executor__(self):
+        executor = self.__executors__[self.args.backend](
+            self.args.jobs, self.args.schedule, self.args.mem_budget*1024)
+        executor.set_affinity(self.__cpu_placement__)
+        return executor
+
+    def __cpu_nodes__(self):
+        # The CPUs, that this process can run on, of each NUMA node. Without
+        # the NUMA information they are all in the one node.
+        allowed = os.sched_getaffinity(0)
+        nodes = []
+        node_dir = '/sys/devices/system/node'
+        if os.path.isdir(node_dir):
+            for node in sorted(
+                    [n for n in os.listdir(node_dir) if re.match(r'node\d+$', n)],
+                    key=lambda n: int(n[4:])):
+                with open(os.path.join(node_dir, node, 'cpulist'), 'r') as f:
+                    cpus = [c for c in self.__cpu_list__(f.read())
+                            if c in allowed]
+                if cpus:
+                    nodes.append(cpus)
+        return nodes or [sorted(allowed)]
+
+    def __cpu_list__(self, cpu_list):
+        # Parses the kernel CPU list format, i.e. "0-3,8-11".
+        cpus = []
+        for r in cpu_list.strip().split(','):
+            if r:
+                r = [int(c) for c in r.split('-')]
+                cpus.extend(range(r[0], r[-1]+1))
+        return cpus
+
+    def __placement__(self):
+        # The CPU sets of the job slots, or None to not pin them.
+        if self.args.affinity == 'none' and self.args.cores <= 0:
+            return None
+        if not hasattr(os, 'sched_setaffinity'):
+            raise RuntimeError(
+                'The --affinity and --cores options are not supported on this platform.')
+        nodes = self.__cpu_nodes__()
+        if self.args.affinity == 'spread':
+            cpus = [c for cs in itertools.zip_longest(*nodes)
+                    for c in cs if c is not None]
+        else:
+            cpus = [c for cs in nodes for c in cs]
+        if self.args.cores > 0:
+            if self.args.cores > len(cpus):
+                raise ValueError('Only %s CPUs available for --cores=%s.' % (
+                    len(cpus), self.args.cores))
+            cpus = cpus[0:self.args.cores]
+        if self.args.trace:
+            print('PLACEMENT: nodes = %s, cpus = %s' % (nodes, cpus))
+        if self.args.affinity == 'none':
+            return [set(cpus)]
+        return [set([c]) for c in cpus]
 
     def __test_build__(self):
+        return self.__test_runs__(self.__run_sample__)
+
+    def __test_rebuild__(self):
+        result = self.__test_runs__(self.__run_rebuild_sample__)
+        edit_node, affected = self.__edit_node__()
+        result['edit_node'] = edit_node
+        result['edit_fanout'] = len(affected)-1
+        return result
+
+    def __test_runs__(self, sample_x):
         args_dir = self.args.dir
         result = {
             'dag_depth': self.args.dag_depth,
+            'schedule': self.args.schedule,
         }
-        if hasattr(self.args, 'kind'):
-            for kind in self.args.kind.split(','):
-                result['dag_jobs_'+kind] = 0.0
-                self.args.kind = kind
-                gen_x = getattr(self, '__generate_%s__' % (kind), False)
-                pre_x = getattr(self, '__pre_%s__' % (kind), False)
-                run_x = getattr(self, '__run_%s__' % (kind), False)
-                self.args.dir = os.path.join(args_dir, kind)
-                if gen_x:
+        self.__sample_dag__()
+        result['dag_depth'] = self.args.dag_depth
+        # The kind directories whose sources are rendered in this sample.
+        self.__rendered__ = set()
+        log = self.__results_log__
+        kinds = self.args.kind.split(',') if hasattr(self.args, 'kind') else []
+        grid = self.__grid__
+        for toolset in grid['toolset']:
+            # The toolsets take turns with the same source trees, as only
+            # the build files differ between them.
+            self.args.toolset = toolset
+            # Generate all the kinds first, so that their runs can be
+            # interleaved.
+            tests = {}
+            series = []
+            for kind in kinds:
+                self.__select_kind__(kind, args_dir)
+                # Kinds can have a "-" that the method names have as "_".
+                name = kind.replace('-', '_')
+                gen_x = getattr(self, '__generate_%s__' % (name), False)
+                pre_x = getattr(self, '__pre_%s__' % (name), False)
+                run_x = getattr(self, '__run_%s__' % (name), False)
+                if not gen_x:
+                    continue
+                gen_key = {
+                    'count': int(self.args.count),
+                    'complexity': self.args.complexity,
+                    'dag_depth': self.args.dag_depth,
+                    'kind': kind,
+                }
+                key = dict(gen_key, toolset=toolset)
+                run_keys = [dict(key, jobs=jobs) for jobs in grid['jobs']]
+                run = run_x and not self.args.no_run
+                x = None
+                # Only generate what still needs to run, when resuming.
+                if (run and not all([self.__runs_done__(log.find('run', **k))
+                                     for k in run_keys])) \
+                        or self.args.no_run or not log.find('generate', **gen_key):
+                    # Only the first toolset renders the sources, the others
+                    # only generate their build files.
+                    rendered = self.args.dir in self.__rendered__
+                    t0 = default_timer()
                     x = gen_x()
+                    if not rendered:
+                        log.append(dict(gen_key, record='generate',
+                                        gen_time=default_timer()-t0))
                     if pre_x:
                         pre_x()
+                result['gen_time_'+self.__series__(kind)] \
+                    = log.find('generate', **gen_key)[-1]['gen_time']
+                for run_key in run_keys:
+                    name = self.__series__(kind, toolset, run_key['jobs'])
+                    result['dag_jobs_'+name] = 0.0
                     if self.args.no_run:
-                        result['dag_jobs_'+kind] = 0
-                        result[kind] = 0.0
+                        result['dag_jobs_'+name] = 0
+                        result[name] = 0.0
                     elif run_x:
-                        run_dag_jobs = []
-                        run_time = []
-                        for sample_i in range(self.args.run_samples):
-                            run_executor = x.copy()
-                            t0 = default_timer()
-                            if self.args.use_ninja:
-                                with PushDir(self.args.dir) as dir:
-                                    self.__check_call__(['ninja',
-                                                         '-f', os.path.join(
-                                                             dir, 'build.ninja'),
-                                                         '-j', str(self.args.jobs)])
-                                run_dag_jobs.append(math.nan)  # ???
-                            else:
-                                run_dag_jobs.append(run_x(run_executor))
-                            run_time.append(default_timer()-t0)
-                            if self.args.exec_stats:
-                                self.__save_data__(
-                                    self.args.exec_stats, run_executor.command_stats)
-                        run_time.sort()
-                        if len(run_time) >= 5:
-                            run_time = run_time[1:-2]
-                        result['dag_jobs_' + kind] \
-                            = math.fsum(run_dag_jobs)/float(len(run_dag_jobs))
-                        result[kind] \
-                            = math.fsum(run_time)/float(len(run_time))
-                        print("KIND: %s, DEPTH: %s JOBS: %s => %s" %
-                              (kind, self.args.dag_depth,
-                               result['dag_jobs_'+kind], result[kind]))
+                        tests[name] = (
+                            run_key, x and x.copy(run_key['jobs']), run_x)
+                        series.append(name)
+            # Run a sample of each kind, and number of jobs, in turn. The
+            # order alternates in each round, so that drift in the machine
+            # affects all of them alike.
+            active = [s for s in series
+                      if not self.__runs_done__(log.find('run', **tests[s][0]))]
+            round_i = 0
+            while active:
+                for name in (active if round_i % 2 == 0 else reversed(active)):
+                    key, x, run_x = tests[name]
+                    self.__select_kind__(key['kind'], args_dir)
+                    self.args.jobs = key['jobs']
+                    log.append(dict(
+                        key, record='run', run=len(log.find('run', **key)),
+                        **sample_x(x, run_x)))
+                active = [s for s in active
+                          if not self.__runs_done__(log.find('run', **tests[s][0]))]
+                round_i += 1
+            for name in series:
+                key = tests[name][0]
+                runs = log.find('run', **key)
+                if self.args.ci_width <= 0:
+                    runs = [r for r in runs if r['run'] < self.args.run_samples]
+                result.update(self.__summarize_runs__(name, runs))
+                self.__table_rows__.extend(runs)
+                print("KIND: %s, DEPTH: %s JOBS: %s => %s" %
+                      (name, self.args.dag_depth,
+                       result['dag_jobs_'+name], result[name]))
         self.args.dir = args_dir
         return result
 
+    def __series__(self, kind, toolset=None, jobs=None):
+        # The name of the results of the kind, qualified by the toolset and
+        # the number of jobs when those are swept.
+        name = kind
+        if toolset and len(self.__grid__['toolset']) > 1:
+            name += '-' + toolset
+        if jobs and len(self.__grid__['jobs']) > 1:
+            name += '-j%s' % (jobs)
+        return name
+
+    # The leading columns of the long format table, any other results of
+    # the runs follow.
+    __table_columns__ = [
+        'count', 'complexity', 'dag_depth', 'kind', 'toolset', 'jobs', 'run',
+        'time']
+
+    def __save_table__(self, table_file, rows):
+        rows = [dict([(k, v) for k, v in r.items() if k != 'record'])
+                for r in rows]
+        if self.args.debug:
+            return
+        with open(table_file, 'w', newline='') as f:
+            if os.path.splitext(table_file)[1] == '.csv':
+                columns = self.__table_columns__ + sorted(
+                    set(k for r in rows for k in r)
+                    - set(self.__table_columns__))
+                writer = csv.writer(f)
+                writer.writerow(columns)
+                for r in rows:
+                    writer.writerow([
+                        json.dumps(r[c], allow_nan=False)
+                        if isinstance(r.get(c), (list, dict))
+                        else r.get(c) for c in columns])
+            else:
+                for r in rows:
+                    f.write(json.dumps(
+                        r, sort_keys=True, allow_nan=False) + '\n')
+
+    def __select_kind__(self, kind, args_dir):
+        self.args.kind = kind
+        self.args.dir = os.path.join(args_dir, kind)
+
+    def __runs_done__(self, runs):
+        # Fixed sampling takes --run-samples runs. Adaptive sampling goes on
+        # until the confidence interval is narrow enough, or the maximum
+        # number of runs is reached.
+        if len(runs) < self.args.run_samples:
+            return False
+        if self.args.ci_width <= 0 or len(runs) >= self.args.max_samples:
+            return True
+        stats = self.__run_stats__([r['time'] for r in runs])
+        return stats['ci'] is not None \
+            and stats['ci'] <= self.args.ci_width*stats['mean']
+
+    # Two sided 95% Student's t critical values, by degrees of freedom. There
+    # is none for zero degrees of freedom.
+    __t95__ = [
+        None, 12.706, 4.303, 3.182, 2.776, 2.571, 2.447, 2.365, 2.306,
+        2.262, 2.228, 2.201, 2.179, 2.160, 2.145, 2.131, 2.120, 2.110, 2.101,
+        2.093, 2.086, 2.080, 2.074, 2.069, 2.064, 2.060, 2.056, 2.052, 2.048,
+        2.045, 2.042]
+
+    def __run_stats__(self, times):
+        n = len(times)
+        stats = {
+            'samples': n,
+            'mean': statistics.mean(times),
+            'median': statistics.median(times),
+            # Undefined for a single sample.
+            'stddev': statistics.stdev(times) if n > 1 else None,
+            'ci': None,
+            'outliers': 0,
+        }
+        if n > 1:
+            t = self.__t95__[n-1] if n-1 < len(self.__t95__) else 1.960
+            stats['ci'] = t*stats['stddev']/math.sqrt(n)
+        if n >= 4:
+            # Tukey's fences.
+            q1, q2, q3 = statistics.quantiles(times, n=4)
+            fence = 1.5*(q3-q1)
+            stats['outliers'] = len(
+                [t for t in times if t < q1-fence or t > q3+fence])
+        return stats
+
+    def __run_sample__(self, x, run_x, clean=True):
+        run = {'dag_jobs': 0.0}
+        run_executor = x.copy()
+        ninja_log = os.path.join(self.args.dir, '.ninja_log')
+        if self.args.use_ninja and clean:
+            # Generated trees are kept between samples, so start each ninja
+            # build from clean. And with a fresh log, to only have the
+            # entries of this build in it.
+            with PushDir(self.args.dir) as dir:
+                self.__check_call__(['ninja',
+                                     '-f', os.path.join(dir, 'build.ninja'),
+                                     '-t', 'clean'])
+            if os.path.exists(ninja_log) and not self.args.debug:
+                os.remove(ninja_log)
+        ninja_log_before = self.__read_ninja_log__(ninja_log)
+        if self.args.time_phases:
+            self.__remove_phases__()
+        if self.__mapper__:
+            self.__mapper__.reset()
+        if self.args.scan and any(
+                [run_executor.kind(id) == 'modules' for id in run_executor.ids]):
+            run['scan_time'] = self.__scan_modules__(run_executor)
+        t0 = default_timer()
+        if self.args.use_ninja:
+            # Ninja, and so its commands, runs on all the CPUs of the slots.
+            affinity = os.sched_getaffinity(0) \
+                if self.__cpu_placement__ else None
+            if affinity:
+                os.sched_setaffinity(0, set().union(*self.__cpu_placement__))
+            try:
+                with PushDir(self.args.dir) as dir:
+                    self.__check_call__(['ninja',
+                                         '-f', os.path.join(dir, 'build.ninja'),
+                                         '-j', str(self.args.jobs)])
+            finally:
+                if affinity:
+                    os.sched_setaffinity(0, affinity)
+        else:
+            run_x(run_executor)
+            if self.args.mem_budget > 0:
+                run['admit_wait'] = run_executor.admit_wait
+        run['time'] = default_timer()-t0
+        command_stats = run_executor.command_stats
+        if self.args.use_ninja:
+            command_stats = self.__ninja_stats__(
+                run_executor, ninja_log, ninja_log_before)
+        run.update(run_executor.analyze(command_stats))
+        if self.args.time_phases:
+            run['phases'] = self.__read_phases__()
+        if not self.args.debug:
+            run.update(self.__artifact_stats__(run_executor))
+        for field, key in [('rchar', 'read_bytes'), ('wchar', 'write_bytes')]:
+            io = [r[Executor.stats_fields.index(field)] for r in command_stats
+                  if r[Executor.stats_fields.index(field)] is not None]
+            if io:
+                run[key] = sum(io)
+        if self.__mapper__ and self.__mapper__.log:
+            mapper_modules = self.__mapper__.modules()
+            run['mapper_requests'] = len(self.__mapper__.log)
+            run['mapper_imports'] = sum(
+                [len(c['imports']) for c in mapper_modules.values()])
+            if self.args.mapper_log:
+                self.__save_data__(self.args.mapper_log, {
+                    'requests': self.__mapper__.log,
+                    'modules': mapper_modules})
+        if self.args.exec_stats:
+            self.__save_data__(self.args.exec_stats, command_stats)
+        return run
+
+    def __read_ninja_log__(self, ninja_log):
+        # The last entry of each output in the ninja log, as its fields.
+        entries = {}
+        if os.path.exists(ninja_log):
+            with open(ninja_log, 'r') as f:
+                for line in f:
+                    if line.startswith('#'):
+                        continue
+                    fields = line.rstrip('\n').split('\t')
+                    if len(fields) >= 5:
+                        entries[fields[3]] = tuple(fields)
+        return entries
+
+    def __ninja_stats__(self, executor, ninja_log, before=None):
+        # Reads the entries of the last build from the ninja log as
+        # command_stats records. Those are the entries that are not in the
+        # log from before the build, as ninja can recompact the log and so
+        # what the build added is not simply at the end of it. Ninja does
+        # not say which job slot ran a command, so slots are assigned in
+        # order of the start times. And the commands could run on any of
+        # the CPUs ninja was given.
+        entries = []
+        cpus = self.__cpu_placement__
+        if cpus:
+            cpus = sorted(set().union(*cpus))
+        before = before or {}
+        seen = set()
+        for output, fields in self.__read_ninja_log__(ninja_log).items():
+            if before.get(output) == fields:
+                continue
+            id = executor.output_task(os.path.join(self.args.dir, output))
+            if id is None:
+                id = output
+            # Edges with more than one output have an entry for each.
+            key = (fields[0], fields[1], id)
+            if key not in seen:
+                seen.add(key)
+                entries.append(
+                    (int(fields[0])/1000.0, int(fields[1])/1000.0, id))
+        entries.sort(key=lambda e: e[0])
+        slots = []
+        records = []
+        for t0, t1, id in entries:
+            slot = 0
+            while slot < len(slots) and slots[slot] > t0:
+                slot += 1
+            if slot == len(slots):
+                slots.append(t1)
+            else:
+                slots[slot] = t1
+            records.append(
+                [slot, t0, t1, t1-t0, id, executor.kind(id)]+[None]*7
+                + [0.0, cpus, None, None])
+        return records
+
+    # The analysis results that are averaged over the runs of a test.
+    __run_analysis__ = [
+        'critical_path', 'ideal_time', 'peak_jobs', 'dep_wait', 'idle_wait',
+        'mapper_requests', 'mapper_imports', 'scan_time', 'bmi_bytes',
+        'obj_bytes', 'import_bytes', 'read_bytes', 'write_bytes',
+        'edit_fanout']
+
+    # The BMI of each TU, by kind, for the import bytes.
+    __bmi_sources__ = {
+        'header-units': 'h%s',
+        'modules': 'm%s',
+    }
+
+    def __artifact_stats__(self, executor):
+        # The bytes of the BMIs, including precompiled headers, and of the
+        # objects the build outputs. And the bytes of the BMIs the TUs pull
+        # in, summed over the TUs. Which for each TU is the BMIs of its
+        # transitive imports, or the precompiled header. Only the outputs of
+        # this build count, as the tree can have those of other builds.
+        sizes = {}
+        for path in executor.outputs:
+            if os.path.isfile(path):
+                sizes[os.path.basename(path)] = os.path.getsize(path)
+        stats = {
+            'bmi_bytes': sum([
+                size for name, size in sizes.items()
+                if os.path.splitext(name)[1] in [
+                    '.gcm', '.pcm', '.gch', '.pch']]),
+            'obj_bytes': sum([
+                size for name, size in sizes.items()
+                if os.path.splitext(name)[1] == '.o']),
+            'import_bytes': 0,
+        }
+        if self.args.kind == 'pch':
+            stats['import_bytes'] = int(self.args.count) \
+                * sizes.get(self.__pch_output__, 0)
+        elif self.args.kind in self.__bmi_sources__:
+            bmi_t = self.__bmi_sources__[self.args.kind] \
+                + ('.gcm' if self.args.toolset == 'gcc' else '.pcm')
+            # The levels only depend on the levels before them.
+            imports = {}
+            for level in self.dag['levels']:
+                for m in level:
+                    imports[m['index']] = set(m['deps']).union(
+                        *[imports.get(d, set()) for d in m['deps']])
+            stats['import_bytes'] = sum([
+                sizes.get(bmi_t % (d), 0)
+                for n in imports for d in imports[n]])
+        return stats
+
+    def __run_rebuild_sample__(self, x, run_x):
+        # Full build, edit one TU, and time rebuilding what it affects. The
+        # executor only gets the tasks of the affected TUs, like a build
+        # system would, and ninja works it out itself.
+        edit_node, affected = self.__edit_node__()
+        self.__run_sample__(x, run_x)
+        source = self.__edit_source__(edit_node)
+        try:
+            ids = [id for id in x.ids if self.__task_tu__(id) in affected]
+            if 'pch' in x.ids and affected.intersection(self.__pch_tus__):
+                # All the TUs include the precompiled header, and are rebuilt
+                # with it, as ninja does.
+                ids = x.ids
+                affected = set([self.__task_tu__(id) for id in ids
+                                if self.__task_tu__(id) is not None])
+            run = self.__run_sample__(x.subset(ids), run_x, clean=False)
+            run['edit_fanout'] = len(affected)-1
+        finally:
+            # Put back the generated content, as the generated tree is
+            # reused, and its manifest says the file is unchanged.
+            self.__edit_source__(edit_node, source)
+        return run
+
+    @staticmethod
+    def __edit_node_arg__(value):
+        # One of the named TUs, or a TU index.
+        if value.isdigit():
+            return int(value)
+        if value not in ['root', 'mid', 'leaf']:
+            raise argparse.ArgumentTypeError(
+                "invalid choice: %r (choose from 'root', 'mid', 'leaf', or a TU index)" % (
+                    value))
+        return value
+
+    def __edit_node__(self):
+        # The TU to edit and the set of TUs that need to be rebuilt after it
+        # changes, i.e. it and its transitive dependents.
+        levels = self.dag['levels']
+        if isinstance(self.args.edit_node, int):
+            edit_node = self.args.edit_node
+            if edit_node not in [m['index'] for l in levels for m in l]:
+                raise ValueError('Edit node %s is not in the DAG of %s TUs.' % (
+                    edit_node, self.args.count))
+        else:
+            edit_node = {
+                'root': levels[0],
+                'mid': levels[len(levels)//2],
+                'leaf': levels[-1],
+            }[self.args.edit_node][0]['index']
+        dependents = {}
+        for level in levels:
+            for m in level:
+                for d in m['deps']:
+                    dependents.setdefault(d, []).append(m['index'])
+        affected = set([edit_node])
+        todo = [edit_node]
+        while todo:
+            for d in dependents.get(todo.pop(), []):
+                if d not in affected:
+                    affected.add(d)
+                    todo.append(d)
+        return edit_node, affected
+
+    # The source file of a TU, by kind, to edit for a rebuild.
+    __edit_sources__ = {
+        'headers': 'h%s.hpp',
+        'pch': 'h%s.hpp',
+        'header-units': 'h%s.hpp',
+        'modules': 'm%s.mpp',
+    }
+
+    def __edit_source__(self, n, restore=None):
+        # Edits the TU source and returns its previous content, or restores
+        # the given content.
+        path = os.path.join(
+            self.args.dir, self.__edit_sources__[self.args.kind] % (n))
+        if self.args.trace:
+            print('EDIT: %s, %s' % (
+                'restore' if restore is not None else self.args.edit, path))
+        if self.args.debug:
+            return None
+        if restore is not None:
+            with open(path, 'w') as f:
+                f.write(restore)
+            return None
+        with open(path, 'r') as f:
+            source = f.read()
+        if self.args.edit == 'touch':
+            os.utime(path)
+        else:
+            with open(path, 'a') as f:
+                f.write('// edit\n')
+        return source
+
+    @staticmethod
+    def __task_tu__(id):
+        # Task ids are the TU index, optionally followed by a "-" suffix.
+        # Other ids are of tasks that the TUs share, like the pch.
+        tu = str(id).split('-')[0]
+        return int(tu) if tu.isdigit() else None
+
+    def __summarize_runs__(self, kind, runs):
+        result = {}
+        stats = self.__run_stats__([r['time'] for r in runs])
+        for k, v in stats.items():
+            result[k + '_' + kind] = v
+        # The fixed count time is the mean without the fastest and the
+        # slowest runs, when there are enough of them.
+        run_time = sorted([r['time'] for r in runs])
+        if len(run_time) >= 5:
+            run_time = run_time[1:-1]
+        run_dag_jobs = [r['dag_jobs'] for r in runs]
+        result['dag_jobs_' + kind] \
+            = math.fsum(run_dag_jobs)/float(len(run_dag_jobs))
+        if self.args.ci_width > 0:
+            result[kind] = stats['median']
+        else:
+            result[kind] \
+                = math.fsum(run_time)/float(len(run_time))
+        for k in self.__run_analysis__:
+            values = [r[k] for r in runs if k in r]
+            if values:
+                result[k + '_' + kind] = math.fsum(values)/float(len(values))
+        utilization = [r['utilization'] for r in runs if 'utilization' in r]
+        if utilization:
+            result['utilization_' + kind] = [
+                math.fsum(u)/float(len(u)) for u in zip(*utilization)]
+        phases = [r['phases'] for r in runs if 'phases' in r]
+        for name in sorted(set(k for p in phases for k in p)):
+            result['phase_%s_%s' % (name, kind)] = math.fsum(
+                [p.get(name, 0.0) for p in phases])/float(len(phases))
+        run_admit_wait = [r['admit_wait'] for r in runs if 'admit_wait' in r]
+        if run_admit_wait:
+            result['admit_wait_' + kind] \
+                = math.fsum(run_admit_wait)/float(len(run_admit_wait))
+        return result
+
     __std_includes__ = [
         '#include <regex>',
         '#include <iostream>',
@@ -341,7 +1807,7 @@ class Test(Main):
     @property
     def std_includes(self):
         if self.args.use_std:
-            if self.args.kind == 'headers':
+            if self.args.kind in ['headers', 'pch', 'header-units']:
                 l = roundi(float(self.args.complexity)
                            * len(self.__std_includes__))
                 return self.__std_includes__[0:l]
@@ -358,17 +1824,27 @@ class Test(Main):
         '#include <string.h>',
     ]
 
-    @property
-    def c_includes(self):
+    def __choose_c_includes__(self, options):
         if self.args.use_c_headers:
-            return [random.choice(self.__c_includes__)]
+            return [self.__c_includes__[options['c_include']]]
         else:
             return []
 
+    # Rendered declaration blocks, keyed by the options that affect them.
+    __cpp_code_cache__ = {}
+
     @property
     def cpp_code(self):
-        result = []
         export = 'export' if self.args.kind == 'modules' else ''
+        key = (export, self.args.complexity,
+               self.args.def_ints, self.args.def_templates)
+        if key not in self.__cpp_code_cache__:
+            self.__cpp_code_cache__[key] = '\n'.join(
+                self.__make_cpp_code__(export))
+        return self.__cpp_code_cache__[key]
+
+    def __make_cpp_code__(self, export):
+        result = []
         if self.args.def_ints:
             for i in range(roundi(float(self.args.complexity)*1000)):
                 result.append(
@@ -386,7 +1862,12 @@ class Test(Main):
 
     @property
     def cxx(self):
-        result = os.getenv('CXX')
+        if self.args.fake_cxx:
+            return os.path.join(
+                os.path.dirname(os.path.abspath(__file__)), 'fake_cxx.py')
+        # A sweep over the toolsets needs a compiler for each of them.
+        result = os.getenv('CXX_%s' % (self.args.toolset.upper())) \
+            or os.getenv('CXX')
         if self.args.toolset == 'gcc':
             if not result and os.path.isfile('/Developer/Tools/gcc-modules/bin/g++-mxx'):
                 result = '/Developer/Tools/gcc-modules/bin/g++-mxx'
@@ -400,31 +1881,160 @@ class Test(Main):
                 result = 'clang++'
         return result
 
+    def __map__(self, name, items):
+        # Calls the named method for each of the argument tuples, using the
+        # generator process pool when there is one.
+        work = [(self, name) + tuple(i) for i in items]
+        pool = getattr(self, '__gen_pool__', None)
+        if pool:
+            return pool.map(
+                __pool_function__, work,
+                max(1, len(work)//(4*self.args.gen_jobs)))
+        return [__pool_function__(w) for w in work]
+
+    def __render__(self, name, items):
+        # The sources of the TUs, rendered by the named method. Or None for
+        # each, to keep the files, when they were already rendered in the
+        # sample for another toolset.
+        rendered = getattr(self, '__rendered__', set())
+        if self.args.dir in rendered:
+            return [None]*len(items)
+        rendered.add(self.args.dir)
+        return self.__map__(name, items)
+
+    def __getstate__(self):
+        # Instances are sent to the generator processes, the pool, the
+        # results log, and the mapper server stay behind.
+        state = dict(self.__dict__)
+        state.pop('__gen_pool__', None)
+        state.pop('__results_log__', None)
+        state.pop('__mapper__', None)
+        return state
+
+    def __gcc_mapper__(self, dir):
+        # The address of the mapper server, or the module map file.
+        if getattr(self, '__mapper__', None):
+            return self.__mapper__.address
+        return os.path.join(dir, 'mm.csv')
+
+    def __close_tree__(self, tree):
+        tree.close()
+        if self.args.trace:
+            print('GENERATE: %s, written = %s, unchanged = %s, removed = %s' % (
+                tree.dir, tree.written, tree.skipped, tree.removed))
+
+    # Compile tasks do not run the compiler themselves, they return the
+    # spawn spec for the executor to run. Which avoids changing the working
+    # directory of the whole process from the executor threads.
+    def __compile__(self, cc, cwd, output=None):
+        spec = {'command': cc, 'cwd': cwd}
+        if self.args.time_phases and output:
+            output = os.path.join(cwd, output)
+            if self.args.toolset == 'gcc':
+                cc.append('-ftime-report')
+                spec['stderr'] = output + '.ftime-report'
+            elif self.args.toolset == 'clang':
+                cc.append('-ftime-trace=%s.ftime-trace.json' % (output))
+        if self.args.debug:
+            print('C++: "%s"' % ('" "'.join(cc)))
+            return {'delay': random.uniform(0.0, 0.1)}
+        if self.args.trace:
+            print('EXEC: "' + '" "'.join(cc) + '"')
+        return spec
+
+    @property
+    def __ninja_phases__(self):
+        # The same phase timing flags, and outputs, for the ninja rules.
+        if not self.args.time_phases:
+            return ''
+        if self.args.toolset == 'gcc':
+            return ' -ftime-report 2> $out.ftime-report'
+        elif self.args.toolset == 'clang':
+            return ' -ftime-trace=$out.ftime-trace.json'
+        return ''
+
+    __phase_files__ = ['*.ftime-report', '*.ftime-trace.json']
+
+    # The -ftime-report timers of gcc, and the -ftime-trace totals of clang,
+    # that make up the phase timings.
+    __gcc_phases__ = [
+        'phase setup', 'phase parsing', 'phase lang. deferred',
+        'phase opt and generate', 'phase stream in', 'phase stream out',
+        'phase finalize', 'template instantiation', 'module import',
+        'module export']
+    __clang_phases__ = [
+        'Frontend', 'Backend', 'Source', 'Module Load', 'ParseClass',
+        'InstantiateClass', 'InstantiateFunction',
+        'PerformPendingInstantiations', 'CodeGen Function']
+
+    def __phase_name__(self, name):
+        name = re.sub(r'^phase ', '', name)
+        name = re.sub(r'(?<=[a-z])(?=[A-Z])', '_', name)
+        return re.sub(r'[^a-z0-9]+', '_', name.lower()).strip('_')
+
+    def __read_phases__(self):
+        # Sums the wall time of each phase over the TUs of the build.
+        phases = {}
+        for phase_file in sorted(glob.glob(os.path.join(
+                self.args.dir, self.__phase_files__[0]))):
+            with open(phase_file, 'r') as f:
+                for line in f:
+                    m = re.match(
+                        r'\s*(.+?)\s*:\s*[\d.]+\s*\(\s*\d+%\)\s*[\d.]+\s*\(\s*\d+%\)\s*([\d.]+)',
+                        line)
+                    if not m:
+                        m = re.match(
+                            r'\s*(TOTAL)\s*:\s*[\d.]+\s+[\d.]+\s+([\d.]+)', line)
+                    if m and (m.group(1) in self.__gcc_phases__
+                              or m.group(1) == 'TOTAL'):
+                        name = self.__phase_name__(m.group(1))
+                        phases[name] = phases.get(name, 0.0) \
+                            + float(m.group(2))
+        for phase_file in sorted(glob.glob(os.path.join(
+                self.args.dir, self.__phase_files__[1]))):
+            for event in self.__load_data__(phase_file).get('traceEvents', []):
+                name = event.get('name', '')
+                if not name.startswith('Total '):
+                    continue
+                name = name[len('Total '):]
+                if name == 'ExecuteCompiler':
+                    name = 'total'
+                elif name not in self.__clang_phases__:
+                    continue
+                name = self.__phase_name__(name)
+                phases[name] = phases.get(name, 0.0) + event['dur']/1000000.0
+        return phases
+
+    def __remove_phases__(self):
+        if self.args.debug:
+            return
+        for pattern in self.__phase_files__:
+            for phase_file in glob.glob(os.path.join(self.args.dir, pattern)):
+                os.remove(phase_file)
+
     # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~ MODULES...
 
     def __generate_modules__(self):
-        if os.path.exists(self.args.dir):
-            shutil.rmtree(self.args.dir)
-            os.makedirs(self.args.dir)
-        dag_levels = self.__generate_dag__()
-        executor = Executor(self.args.jobs)
+        tree = SourceTree(self.args.dir, self.args.debug)
+        dag_levels = self.dag['levels']
+        executor = self.__executor__()
         modules_levels = []
         if self.args.use_std:
             std_modules_dir = os.path.join(
                 self.dir, '..', 'std-modules', 'libstd-modules')
             with PushDir(self.args.dir) as dir:
-                os.symlink(
+                tree.symlink(
                     os.path.join(std_modules_dir, 'std-core.mxx'),
-                    os.path.join(dir, 'std.core.mpp'))
-                os.symlink(
+                    'std.core.mpp')
+                tree.symlink(
                     os.path.join(std_modules_dir, 'std-io.mxx'),
-                    os.path.join(dir, 'std.io.mpp'))
-                os.symlink(
+                    'std.io.mpp')
+                tree.symlink(
                     os.path.join(std_modules_dir, 'std-regex.mxx'),
-                    os.path.join(dir, 'std.regex.mpp'))
-                os.symlink(
+                    'std.regex.mpp')
+                tree.symlink(
                     os.path.join(std_modules_dir, 'std-threading.mxx'),
-                    os.path.join(dir, 'std.threading.mpp'))
+                    'std.threading.mpp')
                 modules_levels.append([
                     os.path.join(dir, 'std.core.mpp'),
                 ])
@@ -432,7 +2042,7 @@ class Test(Main):
                     os.path.join(dir, 'std.io.mpp'),
                 ])
         with PushDir(self.args.dir) as dir:
-            ninja_file = open(os.path.join(dir, 'build.ninja'), 'w')
+            ninja_file = io.StringIO()
             ninja = ninja_syntax.Writer(ninja_file, width=100)
 
             if self.args.use_std:
@@ -441,27 +2051,30 @@ class Test(Main):
 
             if self.args.toolset == 'gcc':
                 two_phase = False
-                ninja.variable('MAPFLAG', '-fmodule-mapper="{dir}/mm.csv"'.format(dir=dir))
+                ninja.variable('MAPFLAG', '-fmodule-mapper="{mapper}"'.format(
+                    mapper=self.__gcc_mapper__(dir)))
                 ninja.rule('CXX',
-                           command='"{cxx}" $CXXFLAGS $MAPFLAG -x c++ $in -o $out'.format(
-                               cxx=self.cxx),
+                           command='"{cxx}" $CXXFLAGS $MAPFLAG -x c++ $in -o $out{phases}'.format(
+                               cxx=self.cxx, phases=self.__ninja_phases__),
                            description='CXX $out')
             elif self.args.toolset == 'clang':
                 two_phase = True
                 ninja.variable('MAPFLAG', '"@{dir}/mm.txt"'.format(dir=dir))
                 ninja.rule('CXX',
-                           command='"{cxx}" $CXXFLAGS $MAPFLAG $in -o $out'.format(
-                               cxx=self.cxx),
+                           command='"{cxx}" $CXXFLAGS $MAPFLAG $in -o $out{phases}'.format(
+                               cxx=self.cxx, phases=self.__ninja_phases__),
                            description='CXX $out')
                 ninja.rule('CXX-BMI',
-                           command='"{cxx}" $CXXFLAGS $MAPFLAG -x c++-module --precompile $in -o $out'.format(
-                               cxx=self.cxx),
+                           command='"{cxx}" $CXXFLAGS $MAPFLAG -x c++-module --precompile $in -o $out{phases}'.format(
+                               cxx=self.cxx, phases=self.__ninja_phases__),
                            description='CXX-BMI $out')
 
             dag_deps = {}
+            dag_options = {}
             for dag_level in dag_levels:
                 for m in dag_level:
                     dag_deps[m['index']] = m['deps']
+                    dag_options[m['index']] = m
 
                     module_id = 'm%s' % (m['index'])
                     module_mxx = os.path.join(dir, module_id + '.mpp')
@@ -469,119 +2082,205 @@ class Test(Main):
                         executor.add_task(
                             [self.__compile_module__, module_mxx, False],
                             str(m["index"]),
-                            [str(d) for d in m['deps']])
+                            [str(d) for d in m['deps']],
+                            'modules')
                     elif self.args.toolset == 'clang':
                         executor.add_task(
                             [self.__compile_module__, module_mxx, True],
                             str(m["index"])+'-pre',
-                            [str(d)+'-pre' for d in m['deps']])
+                            [str(d)+'-pre' for d in m['deps']],
+                            'modules-bmi')
                         executor.add_task(
                             [self.__compile_module__, module_mxx, False],
                             str(m["index"]),
-                            [str(d)+'-pre' for d in m['deps']+[str(m["index"])]])
+                            [str(d)+'-pre' for d in m['deps']+[str(m["index"])]],
+                            'modules')
 
             module_map = {}
+            module_sources = self.__render__('__make_module_source__', [
+                ('m%s' % (n), ['m%s' % (d) for d in dag_deps[n]], dag_options[n])
+                for n in range(int(self.args.count))])
             for n in range(int(self.args.count)):
                 module_id = 'm%s' % (n)
                 module_mxx = os.path.join(dir, module_id + '.mpp')
                 module_obj = os.path.join(dir, module_id + '.o')
                 module_bmi = None
                 module_deps = ['m%s' % (n) for n in dag_deps[n]]
-                module_source = self.__make_module_source__(
-                    module_id, module_deps)
+                module_source = module_sources[n]
                 if self.args.toolset == 'gcc':
                     module_bmi = os.path.join(dir, module_id + '.gcm')
                     ninja.build(module_obj, 'CXX', module_mxx,
                                 implicit_outputs=module_bmi,
                                 implicit=[os.path.join(dir, dep + '.gcm') for dep in module_deps])
+                    executor.add_output(module_obj, str(n))
+                    executor.add_output(module_bmi, str(n))
                 elif self.args.toolset == 'clang':
                     module_bmi = os.path.join(dir, module_id + '.pcm')
                     ninja.build(module_obj, 'CXX', module_bmi)
                     ninja.build(module_bmi, 'CXX-BMI', module_mxx,
                                 implicit=[os.path.join(dir, dep + '.pcm') for dep in module_deps])
+                    executor.add_output(module_obj, str(n))
+                    executor.add_output(module_bmi, str(n)+'-pre')
                 ninja.default(module_obj)
                 module_map[module_id] = module_bmi
-                if self.args.debug:
+                if self.args.debug and module_source:
                     print('FILE: %s' % (module_mxx))
                     print(module_source)
                     print('-----')
-                else:
-                    with open(module_mxx, 'w') as f:
-                        f.write(module_source)
+                tree.write(module_mxx, module_source)
 
-            ninja_file.close()
+            tree.write('build.ninja', ninja_file.getvalue())
 
             if self.args.debug:
                 print('MAP: %s' % (os.path.join(dir, 'mm.*')))
                 pprint.pprint(module_map)
                 print('-----')
-            else:
-                if self.args.toolset == 'gcc':
-                    with open(os.path.join(dir, 'mm.csv'), 'w') as f:
-                        for module_id, module_bmi in module_map.items():
-                            f.write('%s %s\n' % (module_id, module_bmi))
-                elif self.args.toolset == 'clang':
-                    with open(os.path.join(dir, 'mm.txt'), 'w') as f:
-                        for module_id, module_bmi in module_map.items():
-                            f.write('-fmodule-file=%s=%s\n' %
-                                    (module_id, module_bmi))
+            if self.args.toolset == 'gcc' and self.__mapper__:
+                self.__mapper__.set_map(dir, module_map)
+            elif self.args.toolset == 'gcc':
+                tree.write('mm.csv', ''.join(
+                    ['%s %s\n' % (module_id, module_bmi)
+                     for module_id, module_bmi in module_map.items()]))
+            elif self.args.toolset == 'clang':
+                tree.write('mm.txt', ''.join(
+                    ['-fmodule-file=%s=%s\n' % (module_id, module_bmi)
+                     for module_id, module_bmi in module_map.items()]))
+        self.__close_tree__(tree)
         return executor
 
     def __run_modules__(self, executor):
         with PushDir(self.args.dir):
             executor.run()
-        return 0
 
     # CXX -fmodules-ts m0.mpp -c -O0 -x c++
     def __compile_module__(self, m, pre=False):
-        m_dir = os.path.dirname(m)
+        dir = os.path.dirname(m)
         m_base = os.path.splitext(os.path.basename(m))[0]
-        with PushDir(m_dir) as dir:
-            cc = []
-            if self.args.toolset == 'gcc':
-                if not pre:
-                    cc = [
-                        self.cxx,
-                        '-fmodules-ts', '-c', '-std=c++2a', '-O0',
-                        '-x', 'c++',
-                        '-fmodule-mapper=%s' % (os.path.join(dir, 'mm.csv')),
-                        m_base+'.mpp']
-                    if self.args.use_std:
-                        cc.extend(
-                            ['-I', os.path.join(self.dir, '..', 'std-modules')])
-                    cc.extend([
-                        # '-fmodule-lazy',
-                        # '-fmodule-only',
-                    ])
-            elif self.args.toolset == 'clang':
-                if pre:
-                    cc = [
-                        self.cxx,
-                        '-fmodules-ts', '-c', '-std=c++2a', '-O0',
-                        '-x', 'c++-module',
-                        '--precompile',
-                        '@{dir}/mm.txt'.format(dir=dir),
-                        '-o', '{dir}/{name}.pcm'.format(dir=dir,
-                                                        name=m_base),
-                        os.path.basename(m)]
-                else:
-                    cc = [
-                        self.cxx,
-                        '-fmodules-ts', '-c', '-std=c++2a', '-O0',
-                        '{dir}/{name}.pcm'.format(dir=dir,
-                                                  name=m_base),
-                        '@{dir}/mm.txt'.format(dir=dir),
-                        '-o', '{dir}/{name}.o'.format(dir=dir, name=m_base)]
-                    if self.args.use_std:
-                        cc.extend(
-                            ['-I',
-                                os.path.join(self.dir, '..', 'std-modules')])
-            if self.args.debug:
-                sleep(random.uniform(0.0, 0.1))
-                print('C++: "%s"' % ('" "'.join(cc)))
+        cc = []
+        if self.args.toolset == 'gcc':
+            if not pre:
+                cc = [
+                    self.cxx,
+                    '-fmodules-ts', '-c', '-std=c++2a', '-O0',
+                    '-x', 'c++',
+                    '-fmodule-mapper=%s' % (self.__gcc_mapper__(dir)),
+                    m_base+'.mpp']
+                if self.args.use_std:
+                    cc.extend(
+                        ['-I', os.path.join(self.dir, '..', 'std-modules')])
+                cc.extend([
+                    # '-fmodule-lazy',
+                    # '-fmodule-only',
+                ])
+        elif self.args.toolset == 'clang':
+            if pre:
+                cc = [
+                    self.cxx,
+                    '-fmodules-ts', '-c', '-std=c++2a', '-O0',
+                    '-x', 'c++-module',
+                    '--precompile',
+                    '@{dir}/mm.txt'.format(dir=dir),
+                    '-o', '{dir}/{name}.pcm'.format(dir=dir,
+                                                    name=m_base),
+                    os.path.basename(m)]
             else:
-                if cc:
-                    self.__check_call__(cc)
+                cc = [
+                    self.cxx,
+                    '-fmodules-ts', '-c', '-std=c++2a', '-O0',
+                    '{dir}/{name}.pcm'.format(dir=dir,
+                                              name=m_base),
+                    '@{dir}/mm.txt'.format(dir=dir),
+                    '-o', '{dir}/{name}.o'.format(dir=dir, name=m_base)]
+                if self.args.use_std:
+                    cc.extend(
+                        ['-I',
+                            os.path.join(self.dir, '..', 'std-modules')])
+        if cc:
+            return self.__compile__(
+                cc, dir, m_base + ('.pcm' if pre else '.o'))
+
+    def __scan_modules__(self, executor):
+        # Scans the sources of the modules tasks, in parallel, for the
+        # modules they provide and require, and returns the scan time. The
+        # tasks then depend on what the scan found, as in a build system
+        # that does not know the imports up front. Except for ninja builds,
+        # that have their graph in the build file.
+        dir = os.path.abspath(self.args.dir)
+        tus = sorted(set([self.__task_tu__(id) for id in executor.ids]))
+        scanner = self.__executor__()
+        for n in tus:
+            scanner.add_task(
+                [self.__scan_module__, os.path.join(dir, 'm%s.mpp' % (n))],
+                str(n), [], 'scan')
+        t0 = default_timer()
+        with PushDir(dir):
+            scanner.run()
+        scan_time = default_timer()-t0
+        if self.args.use_ninja or self.args.debug:
+            return scan_time
+        provides = {}
+        requires = {}
+        for n in tus:
+            rule = self.__load_data__(
+                os.path.join(dir, 'm%s.ddi' % (n)))['rules'][0]
+            for p in rule.get('provides', []):
+                provides[p['logical-name']] = n
+            requires[n] = [r['logical-name'] for r in rule.get('requires', [])]
+        # Imports of modules outside of the scanned ones, as in a rebuild,
+        # are already built.
+        two_phase = any(
+            [executor.kind(id) == 'modules-bmi' for id in executor.ids])
+        ids = set(executor.ids)
+        for n in tus:
+            deps = [provides[r] for r in requires[n] if r in provides]
+            if two_phase:
+                if str(n)+'-pre' in ids:
+                    executor.set_deps(
+                        str(n)+'-pre', [str(d)+'-pre' for d in deps])
+                if str(n) in ids:
+                    executor.set_deps(
+                        str(n), [str(d)+'-pre' for d in deps+[n]])
+            elif str(n) in ids:
+                executor.set_deps(str(n), [str(d) for d in deps])
+        return scan_time
+
+    def __scan_module__(self, m):
+        dir = os.path.dirname(m)
+        m_base = os.path.splitext(os.path.basename(m))[0]
+        cc = []
+        if self.args.toolset == 'gcc':
+            cc = [
+                self.cxx,
+                '-std=c++2a', '-fmodules-ts', '-E', '-x', 'c++',
+                m_base+'.mpp',
+                '-MT', m_base+'.ddi', '-MD', '-MF', m_base+'.scan.d',
+                '-fdeps-file=%s.ddi' % (m_base),
+                '-fdeps-target=%s.o' % (m_base),
+                '-fdeps-format=p1689r5',
+                '-o', os.devnull]
+        elif self.args.toolset == 'clang':
+            cc = [
+                self.clang_scan_deps, '-format=p1689', '--',
+                self.cxx,
+                '-std=c++2a', '-x', 'c++-module', '-c', m_base+'.mpp',
+                '-o', m_base+'.o']
+        if self.args.use_std:
+            cc.extend(['-I', os.path.join(self.dir, '..', 'std-modules')])
+        spec = self.__compile__(cc, dir)
+        if self.args.toolset == 'clang' and 'command' in spec:
+            # The scanner prints the dependencies.
+            spec['stdout'] = os.path.join(dir, m_base+'.ddi')
+        return spec
+
+    @property
+    def clang_scan_deps(self):
+        if self.args.fake_cxx:
+            return self.cxx
+        result = os.getenv('CLANG_SCAN_DEPS')
+        if not result:
+            result = os.path.join(
+                os.path.dirname(self.cxx), 'clang-scan-deps')
+        return result
 
     __module_template__ = '''\
 {c_includes}
@@ -598,7 +2297,7 @@ namespace {id}_ns
 import {id};
 '''
 
-    def __make_module_source__(self, id, imports):
+    def __make_module_source__(self, id, imports, options):
         module_size = len(self.__module_template__)
         module_imports = []
         for i in imports:
@@ -608,9 +2307,10 @@ import {id};
         module_exports = []
         module_size += Test.__append__(
             module_exports, '''export int n = 0;''')
-        for c in self.cpp_code:
-            module_size += Test.__append__(module_exports, c)
-        c_includes = self.c_includes
+        cpp_code = self.cpp_code
+        if cpp_code:
+            module_size += Test.__append__(module_exports, cpp_code)
+        c_includes = self.__choose_c_includes__(options)
         if len(c_includes) > 0:
             c_includes = ['module;']+c_includes
         module_source = self.__module_template__.format(
@@ -624,75 +2324,79 @@ import {id};
     # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~ HEADERS...
 
     def __generate_headers__(self):
-        with PushDir(self.args.dir) as dir:
-            shutil.rmtree(dir)
-        dag_levels = self.__generate_dag__()
-        executor = Executor(self.args.jobs)
+        tree = SourceTree(self.args.dir, self.args.debug)
+        dag_levels = self.dag['levels']
+        executor = self.__executor__()
         id_t = 'h%s'
         with PushDir(self.args.dir) as dir:
-            ninja_file = open(os.path.join(dir, 'build.ninja'), 'w')
+            ninja_file = io.StringIO()
             ninja = ninja_syntax.Writer(ninja_file, width=100)
 
             ninja.variable('CXXFLAGS', '-c -std=c++2a -O0 -x c++')
-            ninja.rule('CXX',
-                       command='"{cxx}" $CXXFLAGS $in -o $out'.format(
-                           cxx=self.cxx),
-                       description='CXX $out')
+            if self.args.test == 'rebuild':
+                # Ninja needs the header dependencies to know what to rebuild.
+                ninja.rule('CXX',
+                           command='"{cxx}" $CXXFLAGS -MD -MF $out.d $in -o $out{phases}'.format(
+                               cxx=self.cxx, phases=self.__ninja_phases__),
+                           description='CXX $out',
+                           depfile='$out.d', deps='gcc')
+            else:
+                ninja.rule('CXX',
+                           command='"{cxx}" $CXXFLAGS $in -o $out{phases}'.format(
+                               cxx=self.cxx, phases=self.__ninja_phases__),
+                           description='CXX $out')
 
             dag_deps = {}
+            dag_options = {}
             for dag_level in dag_levels:
                 for m in dag_level:
                     m_cpp = os.path.join(dir, id_t % (m['index']) + '.cpp')
                     executor.add_task(
                         [self.__compile_headers__, m_cpp],
                         m['index'],
-                        [])
+                        [],
+                        'headers')
                     dag_deps[m['index']] = m['deps']
+                    dag_options[m['index']] = m
+            sources = self.__render__('__make_headers_source__', [
+                (id_t % (n), [id_t % (d) for d in dag_deps[n]], dag_options[n])
+                for n in range(int(self.args.count))])
             for n in range(int(self.args.count)):
                 id = id_t % (n)
                 hpp = os.path.join(dir, id + '.hpp')
                 cpp = os.path.join(dir, id + '.cpp')
                 obj = os.path.join(dir, id + '.o')
-                deps = [id_t % (n) for n in dag_deps[n]]
-                source = self.__make_headers_source__(id, deps)
+                source = sources[n] or [None, None]
                 ninja.build(obj, 'CXX', cpp)
                 ninja.default(obj)
-                if self.args.debug:
+                executor.add_output(obj, n)
+                if self.args.debug and sources[n]:
                     print('FILE: %s' % (hpp))
                     print(source[0])
                     print('-----')
                     print('FILE: %s' % (cpp))
                     print(source[1])
                     print('-----')
-                else:
-                    with open(hpp, 'w') as f:
-                        f.write(source[0])
-                    with open(cpp, 'w') as f:
-                        f.write(source[1])
+                tree.write(hpp, source[0])
+                tree.write(cpp, source[1])
+            tree.write('build.ninja', ninja_file.getvalue())
+        self.__close_tree__(tree)
         return executor
 
     def __run_headers__(self, executor):
         with PushDir(self.args.dir):
             executor.run()
-        return 0
 
     # CXX m0.mpp -c -O0 -x c++
     def __compile_headers__(self, m):
-        with PushDir(os.path.dirname(m)):
-            cc = [
-                self.cxx,
-                '-c', '-std=c++2a', '-O0', '-x', 'c++',
-                os.path.basename(m)
-            ]
-            if self.args.debug:
-                sleep(random.uniform(0.0, 0.1))
-                print('C++: "%s"' % ('" "'.join(cc)))
-            else:
-                t0 = default_timer()
-                self.__check_call__(cc)
-                t1 = default_timer()
-                if self.args.trace:
-                    print('C++: "%s" => %s' % ('" "'.join(cc), t1-t0))
+        cc = [
+            self.cxx,
+            '-c', '-std=c++2a', '-O0', '-x', 'c++',
+            os.path.basename(m)
+        ]
+        return self.__compile__(
+            cc, os.path.dirname(m),
+            os.path.splitext(os.path.basename(m))[0] + '.o')
 
     __headers_template__ = '''\
 #ifndef H_GUARD_{id}
@@ -715,37 +2419,328 @@ namespace {id}_ns
 #include "{id}.hpp"
 '''
 
-    def __make_headers_source__(self, id, imports):
+    def __make_headers_source__(self, id, imports, options):
+        # The header units kind has the same sources, with imports instead
+        # of includes.
+        include_template = self.__headers_include_template__
+        cpp_template = self.__headers_cpp_template__
+        if self.args.kind == 'header-units':
+            include_template = self.__header_units_import_template__
+            cpp_template = self.__header_units_cpp_template__
         size = len(self.__headers_template__)
         includes = []
         for i in imports:
             size += Test.__append__(
                 includes,
-                self.__headers_include_template__.format(id=i))
+                include_template.format(id=i))
         exports = []
         size += Test.__append__(
             exports, '''int n = 0;''')
-        for c in self.cpp_code:
-            size += Test.__append__(exports, c)
+        cpp_code = self.cpp_code
+        if cpp_code:
+            size += Test.__append__(exports, cpp_code)
         source = self.__headers_template__.format(
             id=id,
-            c_includes='\n'.join(self.c_includes),
+            c_includes='\n'.join(
+                self.__choose_c_includes__(options)),
             std_includes='\n'.join(self.std_includes),
             includes=''.join(includes),
             exports='\n'.join(exports))
-        source_cpp = self.__headers_cpp_template__.format(
+        source_cpp = cpp_template.format(
             id=id)
         return [source, source_cpp]
 
+    # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~ PCH...
+
+    def __generate_pch__(self):
+        tree = SourceTree(self.args.dir, self.args.debug)
+        dag_levels = self.dag['levels']
+        executor = self.__executor__()
+        id_t = 'h%s'
+        with PushDir(self.args.dir) as dir:
+            ninja_file = io.StringIO()
+            ninja = ninja_syntax.Writer(ninja_file, width=100)
+
+            ninja.variable('CXXFLAGS', '-c -std=c++2a -O0')
+            # Ninja needs the header dependencies to know what to rebuild.
+            rebuild = self.args.test == 'rebuild'
+            ninja.rule('PCH',
+                       command='"{cxx}" $CXXFLAGS{md} -x c++-header $in -o $out{phases}'.format(
+                           cxx=self.cxx, phases=self.__ninja_phases__,
+                           md=' -MD -MF $out.d' if rebuild else ''),
+                       description='PCH $out',
+                       depfile='$out.d' if rebuild else None,
+                       deps='gcc' if rebuild else None)
+            ninja.rule('CXX',
+                       command='"{cxx}" $CXXFLAGS{md} -x c++ -include pch.hpp $in -o $out{phases}'.format(
+                           cxx=self.cxx, phases=self.__ninja_phases__,
+                           md=' -MD -MF $out.d' if rebuild else ''),
+                       description='CXX $out',
+                       depfile='$out.d' if rebuild else None,
+                       deps='gcc' if rebuild else None)
+
+            pch_hpp = os.path.join(dir, 'pch.hpp')
+            pch = os.path.join(dir, self.__pch_output__)
+            executor.add_task(
+                [self.__compile_pch__, pch_hpp, True], 'pch', [], 'pch-header')
+            dag_deps = {}
+            dag_options = {}
+            for dag_level in dag_levels:
+                for m in dag_level:
+                    m_cpp = os.path.join(dir, id_t % (m['index']) + '.cpp')
+                    executor.add_task(
+                        [self.__compile_pch__, m_cpp],
+                        m['index'],
+                        ['pch'],
+                        'pch')
+                    dag_deps[m['index']] = m['deps']
+                    dag_options[m['index']] = m
+            sources = self.__render__('__make_headers_source__', [
+                (id_t % (n), [id_t % (d) for d in dag_deps[n]], dag_options[n])
+                for n in range(int(self.args.count))])
+            pch_source = self.__make_pch_source__(
+                [id_t % (n) for n in self.__pch_tus__])
+            ninja.build(pch, 'PCH', pch_hpp)
+            executor.add_output(pch, 'pch')
+            if self.args.debug:
+                print('FILE: %s' % (pch_hpp))
+                print(pch_source)
+                print('-----')
+            tree.write(pch_hpp, pch_source)
+            for n in range(int(self.args.count)):
+                id = id_t % (n)
+                hpp = os.path.join(dir, id + '.hpp')
+                cpp = os.path.join(dir, id + '.cpp')
+                obj = os.path.join(dir, id + '.o')
+                source = sources[n] or [None, None]
+                ninja.build(obj, 'CXX', cpp, implicit=pch)
+                ninja.default(obj)
+                executor.add_output(obj, n)
+                if self.args.debug and sources[n]:
+                    print('FILE: %s' % (hpp))
+                    print(source[0])
+                    print('-----')
+                    print('FILE: %s' % (cpp))
+                    print(source[1])
+                    print('-----')
+                tree.write(hpp, source[0])
+                tree.write(cpp, source[1])
+            tree.write('build.ninja', ninja_file.getvalue())
+        self.__close_tree__(tree)
+        return executor
+
+    def __run_pch__(self, executor):
+        with PushDir(self.args.dir):
+            executor.run()
+
+    @property
+    def __pch_output__(self):
+        # Both find the precompiled header of an -include next to it.
+        if self.args.toolset == 'clang':
+            return 'pch.hpp.pch'
+        return 'pch.hpp.gch'
+
+    @property
+    def __pch_tus__(self):
+        # The TUs whose headers are in the prefix header.
+        return [m['index'] for m in self.dag['levels'][0]]
+
+    # CXX -x c++-header pch.hpp -o pch.hpp.gch
+    # CXX -c -O0 -x c++ -include pch.hpp h0.cpp
+    def __compile_pch__(self, m, header=False):
+        if header:
+            cc = [
+                self.cxx,
+                '-c', '-std=c++2a', '-O0', '-x', 'c++-header',
+                os.path.basename(m),
+                '-o', self.__pch_output__
+            ]
+            output = self.__pch_output__
+        else:
+            cc = [
+                self.cxx,
+                '-c', '-std=c++2a', '-O0', '-x', 'c++',
+                '-include', 'pch.hpp',
+                os.path.basename(m)
+            ]
+            output = os.path.splitext(os.path.basename(m))[0] + '.o'
+        return self.__compile__(cc, os.path.dirname(m), output)
+
+    __pch_template__ = '''\
+{c_includes}
+{std_includes}
+{includes}
+'''
+
+    def __make_pch_source__(self, ids):
+        return self.__pch_template__.format(
+            c_includes='\n'.join(
+                self.__c_includes__ if self.args.use_c_headers else []),
+            std_includes='\n'.join(self.std_includes),
+            includes=''.join([
+                self.__headers_include_template__.format(id=i)
+                for i in ids]))
+
+    # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~ HEADER UNITS...
+
+    def __generate_header_units__(self):
+        tree = SourceTree(self.args.dir, self.args.debug)
+        dag_levels = self.dag['levels']
+        executor = self.__executor__()
+        id_t = 'h%s'
+        bmi_t = id_t + ('.gcm' if self.args.toolset == 'gcc' else '.pcm')
+        with PushDir(self.args.dir) as dir:
+            ninja_file = io.StringIO()
+            ninja = ninja_syntax.Writer(ninja_file, width=100)
+
+            # The header units are named by their path, as found from the
+            # directory of the build. So the sources are given relative to
+            # it, and not as absolute paths.
+            ninja.variable('CXXFLAGS', '-fmodules-ts -c -std=c++2a -O0')
+            if self.args.toolset == 'gcc':
+                ninja.variable('MAPFLAG', '-fmodule-mapper="{mapper}"'.format(
+                    mapper=self.__gcc_mapper__(dir)))
+                ninja.rule('CXX-HU',
+                           command='"{cxx}" $CXXFLAGS $MAPFLAG -fmodule-header -x c++-header $in{phases}'.format(
+                               cxx=self.cxx, phases=self.__ninja_phases__),
+                           description='CXX-HU $out')
+                ninja.rule('CXX',
+                           command='"{cxx}" $CXXFLAGS $MAPFLAG -x c++ $in -o $out{phases}'.format(
+                               cxx=self.cxx, phases=self.__ninja_phases__),
+                           description='CXX $out')
+            elif self.args.toolset == 'clang':
+                ninja.rule('CXX-HU',
+                           command='"{cxx}" -std=c++2a -O0 -fmodule-header=user $MODFLAGS -x c++-header $in -o $out{phases}'.format(
+                               cxx=self.cxx, phases=self.__ninja_phases__),
+                           description='CXX-HU $out')
+                ninja.rule('CXX',
+                           command='"{cxx}" $CXXFLAGS $MODFLAGS -x c++ $in -o $out{phases}'.format(
+                               cxx=self.cxx, phases=self.__ninja_phases__),
+                           description='CXX $out')
+
+            dag_deps = {}
+            dag_options = {}
+            for dag_level in dag_levels:
+                for m in dag_level:
+                    m_hpp = os.path.join(dir, id_t % (m['index']) + '.hpp')
+                    m_cpp = os.path.join(dir, id_t % (m['index']) + '.cpp')
+                    executor.add_task(
+                        [self.__compile_header_unit__, m_hpp, m['deps'], True],
+                        str(m['index'])+'-pre',
+                        [str(d)+'-pre' for d in m['deps']],
+                        'header-units-bmi')
+                    executor.add_task(
+                        [self.__compile_header_unit__, m_cpp, m['deps'], False],
+                        str(m['index']),
+                        [str(m['index'])+'-pre'],
+                        'header-units')
+                    dag_deps[m['index']] = m['deps']
+                    dag_options[m['index']] = m
+            sources = self.__render__('__make_headers_source__', [
+                (id_t % (n), [id_t % (d) for d in dag_deps[n]], dag_options[n])
+                for n in range(int(self.args.count))])
+            unit_map = {}
+            for n in range(int(self.args.count)):
+                id = id_t % (n)
+                hpp = os.path.join(dir, id + '.hpp')
+                cpp = os.path.join(dir, id + '.cpp')
+                obj = os.path.join(dir, id + '.o')
+                bmi = os.path.join(dir, bmi_t % (n))
+                dep_bmis = [os.path.join(dir, bmi_t % (d))
+                            for d in dag_deps[n]]
+                source = sources[n] or [None, None]
+                if self.args.toolset == 'gcc':
+                    ninja.build(bmi, 'CXX-HU', id + '.hpp',
+                                implicit=dep_bmis)
+                    ninja.build(obj, 'CXX', id + '.cpp', implicit=bmi)
+                elif self.args.toolset == 'clang':
+                    ninja.build(bmi, 'CXX-HU', id + '.hpp',
+                                implicit=dep_bmis,
+                                variables={'MODFLAGS': ' '.join(
+                                    ['-fmodule-file=%s' % (b) for b in dep_bmis])})
+                    ninja.build(obj, 'CXX', id + '.cpp', implicit=bmi,
+                                variables={'MODFLAGS': '-fmodule-file=%s' % (bmi)})
+                ninja.default(obj)
+                executor.add_output(obj, str(n))
+                executor.add_output(bmi, str(n)+'-pre')
+                unit_map['./' + id + '.hpp'] = bmi
+                if self.args.debug and sources[n]:
+                    print('FILE: %s' % (hpp))
+                    print(source[0])
+                    print('-----')
+                    print('FILE: %s' % (cpp))
+                    print(source[1])
+                    print('-----')
+                tree.write(hpp, source[0])
+                tree.write(cpp, source[1])
+            tree.write('build.ninja', ninja_file.getvalue())
+
+            if self.args.toolset == 'gcc' and self.__mapper__:
+                self.__mapper__.set_map(dir, unit_map)
+            elif self.args.toolset == 'gcc':
+                tree.write('mm.csv', ''.join(
+                    ['%s %s\n' % (name, bmi)
+                     for name, bmi in unit_map.items()]))
+        self.__close_tree__(tree)
+        return executor
+
+    def __run_header_units__(self, executor):
+        with PushDir(self.args.dir):
+            executor.run()
+
+    # CXX -fmodules-ts -c -O0 -fmodule-header -x c++-header h0.hpp
+    # CXX -fmodules-ts -c -O0 -x c++ h0.cpp
+    def __compile_header_unit__(self, m, deps, pre=False):
+        dir = os.path.dirname(m)
+        m_base = os.path.splitext(os.path.basename(m))[0]
+        cc = []
+        if self.args.toolset == 'gcc':
+            cc = [
+                self.cxx,
+                '-fmodules-ts', '-c', '-std=c++2a', '-O0',
+                '-fmodule-mapper=%s' % (self.__gcc_mapper__(dir))]
+            if pre:
+                cc.extend(['-fmodule-header', '-x', 'c++-header',
+                           m_base+'.hpp'])
+            else:
+                cc.extend(['-x', 'c++', m_base+'.cpp'])
+        elif self.args.toolset == 'clang':
+            if pre:
+                cc = [self.cxx, '-std=c++2a', '-O0', '-fmodule-header=user']
+                cc.extend(['-fmodule-file=h%s.pcm' % (d) for d in deps])
+                cc.extend(['-x', 'c++-header', m_base+'.hpp',
+                           '-o', m_base+'.pcm'])
+            else:
+                cc = [
+                    self.cxx,
+                    '-fmodules-ts', '-c', '-std=c++2a', '-O0',
+                    '-fmodule-file=%s.pcm' % (m_base),
+                    '-x', 'c++', m_base+'.cpp',
+                    '-o', m_base+'.o']
+        if pre:
+            output = m_base + ('.gcm' if self.args.toolset == 'gcc' else '.pcm')
+        else:
+            output = m_base + '.o'
+        return self.__compile__(cc, dir, output)
+
+    __header_units_import_template__ = '''\
+import "{id}.hpp";
+'''
+
+    __header_units_cpp_template__ = '''\
+import "{id}.hpp";
+'''
+
     # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~ DAG...
 
     def __generate_dag__(self):
         dag_levels = []
         dag_step = float(self.args.count)/float(self.args.dag_depth)
-        # All the deps from the first dag level down to the n-2
-        dag_deps_top = []
+        # All the deps from the first dag level down to the n-2, as a range
+        # to avoid materializing the indices for each level.
+        dag_deps_top = range(0)
         # The deps from dag level n-1
-        dag_deps_prev = []
+        dag_deps_prev = range(0)
         i = 0
         r = 0.0
         while i < int(self.args.count):
@@ -772,25 +2767,71 @@ namespace {id}_ns
                     print('GENERATE_DAG: dag = %s, deps = %s' % (m, dag_deps))
                 dag_level.append({
                     'index': m,
-                    'deps': dag_deps
+                    'deps': sorted(dag_deps),
+                    'c_include': self.random.randrange(
+                        len(self.__c_includes__))
                 })
             dag_levels.append(dag_level)
-            dag_deps_top = list(range(0, i))
-            dag_deps_prev = list(range(i, j))
+            dag_deps_top = range(0, i)
+            dag_deps_prev = range(i, j)
             i = j
         if self.args.trace:
             print('DAG_LEVELS:')
             pprint.pprint(dag_levels)
         return dag_levels
 
+    # The DAG file format holds the generated DAG levels, where each TU has
+    # its index, its deps, and its per TU options, plus the options the DAG
+    # was generated with.
+    __dag_format__ = 'parallel_perf.dag'
+    __dag_version__ = 1
+
+    def __sample_dag__(self):
+        # Loads or generates the DAG for the current sample. It is shared by
+        # all the kinds of the sample so that they build the same graph.
+        if self.args.dag_in:
+            dag = self.__load_data__(
+                self.args.dag_in.format(dag_depth=self.args.dag_depth))
+            if dag.get('format') != self.__dag_format__ \
+                    or dag.get('version') != self.__dag_version__:
+                raise ValueError('Unknown DAG file format in "%s".' % (
+                    self.args.dag_in))
+            self.args.count = dag['count']
+            self.args.dag_depth = dag['dag_depth']
+        else:
+            if self.args.seed is None:
+                self.random = random.Random()
+            else:
+                self.random = random.Random(
+                    '%s:%s' % (self.args.seed, self.args.dag_depth))
+            dag = {
+                'format': self.__dag_format__,
+                'version': self.__dag_version__,
+                'seed': self.args.seed,
+                'count': int(self.args.count),
+                'dag_depth': self.args.dag_depth,
+                'dep_factor': self.args.dep_factor,
+                'dep_max': int(self.args.dep_max),
+                'levels': self.__generate_dag__(),
+            }
+        if self.args.dag_out:
+            self.__save_data__(
+                self.args.dag_out.format(dag_depth=self.args.dag_depth), dag)
+        self.dag = dag
+        return dag
+
     def __choices__(self, sequence, count):
-        # return random.choices(sequence, k=count)
-        result = set()
-        if len(sequence) > 0:
-            count = min(count, len(sequence))
-            while len(result) < count:
-                result.add(random.choice(sequence))
-        return result
+        # Samples without replacement, which for a range only costs the
+        # number of items picked. The usual few picks out of many are drawn
+        # directly, as random.sample has a comparatively large overhead.
+        n = len(sequence)
+        count = min(count, n)
+        if count*2 > n:
+            return self.random.sample(sequence, count)
+        picked = set()
+        while len(picked) < count:
+            picked.add(sequence[self.random.randrange(n)])
+        return list(picked)
 
     @staticmethod
     def __append__(container, item):
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+"""
+    Copyright (C) 2018-2019 Rene Rivera.
+    Use, modification and distribution are subject to the
+    Boost Software License, Version 1.0. (See accompanying file
+    LICENSE_1_0.txt or copy at http://www.boost.org/LICENSE_1_0.txt)
+"""
+import os.path
+from parallel_perf import Main, Executor, SimulatedExecutor
+
+
+class Simulate(Main):
+    '''
+    Replays the task durations of a build, as saved with --exec-stats, with
+    the executor scheduling policies on a virtual clock. This predicts the
+    build time at any number of jobs without running the compilers again.
+    '''
+
+    def __init_parser__(self, parser):
+        parser.add_argument(
+            'exec_stats', nargs='+',
+            help='The exec stats JSON files of the builds to replay.')
+        parser.add_argument(
+            '--dag',
+            help='The DAG JSON file, as saved with --dag-out, the builds were run with. Without it the tasks are independent.')
+        parser.add_argument(
+            '--jobs', default='1,2,4,8,16,32,48,64,80,96,128',
+            help='Comma separated list of the number of parallel jobs to simulate.')
+        parser.add_argument(
+            '--schedule', default='fifo', choices=Executor.schedules,
+            help='Order in which the simulated executor starts ready tasks.')
+        parser.add_argument(
+            '--validate', default=False, action='store_true',
+            help='Compare the simulated to the measured build time, at the number of jobs of each build, or at --jobs when that is a single value.')
+        parser.add_argument(
+            '--json-out',
+            help='Output resulting data table as JSON to a file.')
+
+    def __run__(self):
+        self.dag_deps = {}
+        if self.args.dag:
+            dag = self.__load_data__(self.args.dag)
+            if dag.get('format') != 'parallel_perf.dag':
+                raise ValueError('Unknown DAG file format in "%s".' % (
+                    self.args.dag))
+            for dag_level in dag['levels']:
+                for m in dag_level:
+                    self.dag_deps[m['index']] = m['deps']
+        self.jobs = [int(j) for j in self.args.jobs.split(',')]
+        if self.args.validate:
+            table = self.__validate__()
+        else:
+            table = self.__curves__()
+        for row in table:
+            print(' '.join(['%12s' % (
+                '%.3f' % (c) if isinstance(c, float) else c) for c in row]))
+        if self.args.json_out:
+            self.__save_data__(self.args.json_out, table)
+
+    def __curves__(self):
+        # The predicted build time of each exec stats file, by jobs.
+        columns = ['jobs']
+        tasks = []
+        for exec_stats in self.args.exec_stats:
+            columns.append(os.path.splitext(os.path.basename(exec_stats))[0])
+            tasks.append(self.__tasks__(exec_stats)[0])
+        table = [columns]
+        for jobs in self.jobs:
+            table.append([jobs] + [
+                self.__simulate__(t, jobs) for t in tasks])
+        return table
+
+    def __validate__(self):
+        table = [['exec_stats', 'jobs', 'tasks', 'graph',
+                  'measured', 'simulated', 'error']]
+        for exec_stats in self.args.exec_stats:
+            tasks, command_stats, graph = self.__tasks__(exec_stats)
+            jobs = self.jobs[0] if len(self.jobs) == 1 \
+                else 1+max([r[0] for r in command_stats])
+            measured = max([r[2] for r in command_stats]) \
+                - min([r[1] for r in command_stats])
+            simulated = self.__simulate__(tasks, jobs)
+            table.append([
+                os.path.basename(exec_stats), jobs, len(command_stats), graph,
+                measured, simulated, (simulated-measured)/measured])
+        return table
+
+    def __simulate__(self, tasks, jobs):
+        x = SimulatedExecutor(jobs, self.args.schedule)
+        for task in tasks:
+            x.add_task(*task)
+        x.run()
+        return max([r[2] for r in x.command_stats], default=0.0)
+
+    def __tasks__(self, exec_stats):
+        # The simulated tasks of the build, as add_task arguments. With the
+        # task graph of the generators when the stats have the task ids and
+        # there is a DAG.
+        # Older stats only have the slot and times of each task, and those
+        # are replayed as independent tasks.
+        command_stats = self.__load_data__(exec_stats)
+        graph = bool(self.dag_deps) and all(
+            len(r) > 5 for r in command_stats)
+        duration = {}
+        kind = {}
+        for i, r in enumerate(command_stats):
+            id = r[4] if len(r) > 5 else i
+            duration[id] = duration.get(id, 0.0) + r[3]
+            kind[id] = r[5] if len(r) > 5 else None
+        two_phase = any(k == 'modules-bmi' for k in kind.values())
+        tasks = []
+        for id in duration:
+            deps = self.__task_deps__(id, kind[id], two_phase) if graph \
+                else []
+            tasks.append((duration[id], id, deps, kind[id]))
+        return tasks, command_stats, graph
+
+    def __task_deps__(self, id, kind, two_phase):
+        # The same dependencies as the tasks of the generators have.
+        if kind in ['headers', 'pch-header']:
+            return []
+        if kind == 'pch':
+            return ['pch']
+        n = int(str(id).split('-')[0])
+        if kind in ['modules-bmi', 'header-units-bmi']:
+            return [str(d)+'-pre' for d in self.dag_deps[n]]
+        if kind == 'header-units':
+            return [str(n)+'-pre']
+        if two_phase:
+            return [str(d)+'-pre' for d in self.dag_deps[n]+[n]]
+        return [str(d) for d in self.dag_deps[n]]
+
+
+# ./schedule_sim.py --validate data/*-stat-*.json
+# ./schedule_sim.py --dag=dag.json --jobs=8,16,32,64,128 stat-modules.json stat-headers.json
+
+if __name__ == "__main__":
+    Simulate()